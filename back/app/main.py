@@ -2,23 +2,49 @@
 
 import asyncio
 import csv
+import hashlib
+import heapq
 import json
+import mimetypes
 import os
+import random
 import re
+import shutil
 import sqlite3
+import ssl
+import threading
+import time
 import uuid
 import importlib.util
+from collections import OrderedDict, deque
+from contextvars import ContextVar
 from io import BytesIO
-from datetime import datetime, time as time_value
+from datetime import datetime, time as time_value, timedelta
 from urllib.parse import urlparse
 from typing import Callable, Dict, List, Optional, Tuple
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
+import certifi
+from aiohttp import ClientConnectorError, ClientSession, TCPConnector
 from aiogram import Bot as TelegramBot
 from aiogram import Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.filters import Command
 from aiogram.enums import ParseMode
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramConflictError,
+    TelegramEntityTooLarge,
+    TelegramNetworkError,
+    TelegramNotFound,
+    TelegramRetryAfter,
+    TelegramServerError,
+    TelegramUnauthorizedError,
+)
+from aiogram.methods import GetUpdates, SendChatAction, SendMediaGroup
 from aiogram.types import (
     CallbackQuery,
+    ChatMemberUpdated,
     CopyTextButton,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
@@ -34,11 +60,10 @@ from aiogram.types import (
     WebAppInfo,
     FSInputFile,
 )
-from fastapi import FastAPI, HTTPException, UploadFile, File, Body
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, HTTPException, UploadFile, File, Body, Request
+from fastapi.responses import FileResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr
 
 app = FastAPI(title="Bot Builder API")
 
@@ -56,8 +81,94 @@ FILES_DIR = os.getenv("BOT_FILES", "files")
 PLUGINS_DIR = os.getenv("BOT_PLUGINS", "plugins")
 WEBHOOK_CONFIG_PATH = os.getenv("BOT_WEBHOOK_CONFIG", "webhook_config.json")
 WEBHOOK_BASE_URL = os.getenv("BOT_WEBHOOK_BASE", "").strip()
+PREWARM_CHAT_ID = os.getenv("BOT_PREWARM_CHAT_ID", "").strip()
+MEMBERSHIP_TTL_SECONDS = float(os.getenv("BOT_MEMBERSHIP_TTL", "300"))
+MEMBERSHIP_NEGATIVE_TTL_SECONDS = float(os.getenv("BOT_MEMBERSHIP_NEGATIVE_TTL", "60"))
+PROFILE_PHOTO_RATE = float(os.getenv("BOT_PROFILE_PHOTO_RATE", "5"))
+PROFILE_PHOTO_BATCH_SIZE = max(1, int(os.getenv("BOT_PROFILE_PHOTO_BATCH", "20")))
+PROFILE_PHOTO_QUEUE_SIZE = max(1, int(os.getenv("BOT_PROFILE_PHOTO_QUEUE", "10000")))
+UPDATE_DEDUP_SIZE = max(1, int(os.getenv("BOT_UPDATE_DEDUP_SIZE", "10000")))
+UPDATE_DEDUP_PERSIST = os.getenv("BOT_UPDATE_DEDUP_PERSIST", "").strip().lower() in ("1", "true", "yes")
+UPDATE_DEDUP_PRUNE_EVERY = 1000
+POLLING_TIMEOUT_SECONDS = max(0, int(os.getenv("BOT_POLLING_TIMEOUT", "30")))
+POLLING_LIMIT = min(100, max(1, int(os.getenv("BOT_POLLING_LIMIT", "100"))))
+INGEST_QUEUE_SIZE = max(1, int(os.getenv("BOT_INGEST_QUEUE_SIZE", "10000")))
+CHAT_CONCURRENCY = max(1, int(os.getenv("BOT_CHAT_CONCURRENCY", "32")))
+BOT_MODES = ("auto", "webhook", "polling")
+PREWARM_CONCURRENCY = max(1, int(os.getenv("BOT_PREWARM_CONCURRENCY", "3")))
+UPLOAD_RESCAN_SECONDS = float(os.getenv("BOT_UPLOAD_RESCAN_SECONDS", "300"))
+UPLOAD_CACHE_CONTROL = os.getenv("BOT_UPLOADS_CACHE_CONTROL", "public, max-age=31536000, immutable")
+UPLOAD_MUTABLE_CACHE_CONTROL = os.getenv("BOT_UPLOADS_MUTABLE_CACHE_CONTROL", "no-cache")
+UPLOAD_SENDFILE_HEADER = os.getenv("BOT_UPLOADS_SENDFILE", "").strip()
+UPLOAD_SENDFILE_PREFIX = os.getenv("BOT_UPLOADS_SENDFILE_PREFIX", "/protected-uploads/")
+UPLOAD_PUBLIC_HOSTS = {
+    host.strip().lower()
+    for host in os.getenv("BOT_PUBLIC_HOSTS", "").split(",")
+    if host.strip()
+}
 EXCEL_DIR = os.path.join(FILES_DIR, "excel")
 TEXT_DIR = os.path.join(FILES_DIR, "text")
+TRASH_DIR = os.getenv("BOT_TRASH", os.path.join(FILES_DIR, "trash"))
+GC_INTERVAL_SECONDS = float(os.getenv("BOT_GC_INTERVAL", "3600"))
+GC_MIN_AGE_SECONDS = float(os.getenv("BOT_GC_MIN_AGE", "86400"))
+GC_GRACE_SECONDS = float(os.getenv("BOT_GC_GRACE", "604800"))
+GC_BATCH_SIZE = max(1, int(os.getenv("BOT_GC_BATCH", "200")))
+GC_PAUSE_SECONDS = float(os.getenv("BOT_GC_PAUSE", "0.05"))
+RATE_GLOBAL_PER_SECOND = float(os.getenv("BOT_RATE_GLOBAL", "30"))
+RATE_PRIVATE_PER_SECOND = float(os.getenv("BOT_RATE_PRIVATE", "1"))
+RATE_PRIVATE_BURST = float(os.getenv("BOT_RATE_PRIVATE_BURST", "3"))
+RATE_GROUP_PER_MINUTE = float(os.getenv("BOT_RATE_GROUP_PER_MINUTE", "20"))
+RATE_GROUP_BURST = float(os.getenv("BOT_RATE_GROUP_BURST", "3"))
+RATE_RETRY_LIMIT = max(0, int(os.getenv("BOT_RATE_RETRIES", "5")))
+RATE_PRUNE_THRESHOLD = 1024
+SEND_RETRY_LIMIT = max(0, int(os.getenv("BOT_SEND_RETRIES", "3")))
+SEND_BACKOFF_BASE = float(os.getenv("BOT_SEND_BACKOFF_BASE", "0.5"))
+SEND_BACKOFF_MAX = float(os.getenv("BOT_SEND_BACKOFF_MAX", "30"))
+DEAD_LETTER_RETENTION_DAYS = float(os.getenv("BOT_DEAD_LETTER_RETENTION_DAYS", "14"))
+DEAD_LETTER_MAX_ROWS = max(1, int(os.getenv("BOT_DEAD_LETTER_MAX_ROWS", "10000")))
+DEAD_LETTER_PRUNE_EVERY = 100
+HTTP_POOL_LIMIT = max(1, int(os.getenv("BOT_HTTP_POOL_LIMIT", "100")))
+HTTP_KEEPALIVE_SECONDS = float(os.getenv("BOT_HTTP_KEEPALIVE", "60"))
+HTTP_DNS_TTL_SECONDS = int(os.getenv("BOT_HTTP_DNS_TTL", "300"))
+TELEGRAM_CLIENT_CACHE_SIZE = int(os.getenv("BOT_TELEGRAM_CLIENT_CACHE_SIZE", "1000"))
+HTTP_TIMEOUT_SECONDS = float(os.getenv("BOT_HTTP_TIMEOUT", "60"))
+SEND_PRIORITY_WEIGHTS = {"interactive": 8, "webhook": 4, "scheduled": 2, "broadcast": 1}
+BROADCAST_CONCURRENCY = max(1, int(os.getenv("BOT_BROADCAST_CONCURRENCY", "20")))
+BROADCAST_BATCH_SIZE = max(1, int(os.getenv("BOT_BROADCAST_BATCH", "200")))
+BROADCAST_FLUSH_SIZE = max(1, int(os.getenv("BOT_BROADCAST_FLUSH_SIZE", "50")))
+BROADCAST_FLUSH_SECONDS = float(os.getenv("BOT_BROADCAST_FLUSH_SECONDS", "2"))
+SCHEDULE_MISSED_POLICIES = ("skip", "catchup")
+SCHEDULE_MISSED_POLICY = os.getenv("BOT_SCHEDULE_MISSED", "catchup").strip().lower()
+SCHEDULE_MISSED_GRACE_SECONDS = float(os.getenv("BOT_SCHEDULE_MISSED_GRACE", "60"))
+SCHEDULE_TIMEZONE = os.getenv("BOT_SCHEDULE_TIMEZONE", "").strip()
+SCHEDULE_CONCURRENCY = max(1, int(os.getenv("BOT_SCHEDULE_CONCURRENCY", "4")))
+SCHEDULE_OVERRUN_POLICIES = ("skip", "queue")
+SCHEDULE_OVERRUN_POLICY = os.getenv("BOT_SCHEDULE_OVERRUN", "skip").strip().lower()
+SCHEDULE_RUNS_RETENTION_DAYS = float(os.getenv("BOT_SCHEDULE_RUNS_RETENTION_DAYS", "7"))
+SCHEDULE_RUNS_MAX_ROWS = max(1, int(os.getenv("BOT_SCHEDULE_RUNS_MAX_ROWS", "5000")))
+SCHEDULE_RUNS_PRUNE_EVERY = 100
+CRON_FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 6))
+CRON_NAMES = (
+    {},
+    {},
+    {},
+    {name: index + 1 for index, name in enumerate(
+        ("jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec")
+    )},
+    {name: index for index, name in enumerate(("sun", "mon", "tue", "wed", "thu", "fri", "sat"))},
+)
+CRON_MACROS = {
+    "@yearly": "0 0 1 1 *",
+    "@annually": "0 0 1 1 *",
+    "@monthly": "0 0 1 * *",
+    "@weekly": "0 0 * * 0",
+    "@daily": "0 0 * * *",
+    "@midnight": "0 0 * * *",
+    "@hourly": "0 * * * *",
+}
+SCHEDULE_LEASE_SECONDS = float(os.getenv("BOT_SCHEDULE_LEASE", "300"))
+SCHEDULE_RETRY_SECONDS = float(os.getenv("BOT_SCHEDULE_RETRY", "10"))
+WORKER_ID = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(EXCEL_DIR, exist_ok=True)
 os.makedirs(TEXT_DIR, exist_ok=True)
@@ -67,17 +178,20 @@ os.makedirs(PLUGINS_DIR, exist_ok=True)
 class Flow(BaseModel):
     nodes: List[dict] = Field(default_factory=list)
     edges: List[dict] = Field(default_factory=list)
+    _compiled: Optional[object] = PrivateAttr(default=None)
 
 
 class BotCreate(BaseModel):
     name: str = Field(min_length=1)
     token: Optional[str] = None
+    mode: str = Field(default="auto", pattern="^(auto|webhook|polling)$")
 
 
 class BotUpdate(BaseModel):
     name: Optional[str] = Field(default=None, min_length=1)
     token: Optional[str] = None
     status: Optional[str] = None
+    mode: Optional[str] = Field(default=None, pattern="^(auto|webhook|polling)$")
 
 
 class Bot(BaseModel):
@@ -85,6 +199,7 @@ class Bot(BaseModel):
     name: str
     token: Optional[str] = None
     status: str = "stopped"
+    mode: str = "auto"
     flow: Flow = Field(default_factory=Flow)
 
 
@@ -93,6 +208,250 @@ FLOW_CACHE: Dict[str, Flow] = {}
 PLUGIN_CACHE: Dict[str, dict] = {}
 PLUGIN_NODE_DEFS: Dict[str, dict] = {}
 PLUGIN_HANDLERS: Dict[str, Callable] = {}
+PREWARM_TASKS: Dict[str, asyncio.Task] = {}
+PREWARM_PROGRESS: Dict[str, dict] = {}
+BROADCAST_TASKS: Dict[str, Dict[str, asyncio.Task]] = {}
+DELAYED_SEND_TASKS: Dict[str, set] = {}
+DELAYED_SEND_TAILS: Dict[Tuple[Optional[str], object], asyncio.Task] = {}
+PROFILE_PHOTO_STATE: Dict[str, Optional[object]] = {"queue": None, "task": None}
+PROFILE_PHOTO_PENDING: set[Tuple[str, int]] = set()
+SEEN_UPDATES: Dict[int, LRUCache] = {}
+SEEN_UPDATE_WRITES: Dict[int, int] = {}
+INGEST_STATE: Dict[str, object] = {"queue": None, "pump": None, "executor": None}
+DEAD_LETTER_STATE: Dict[str, int] = {"inserts": 0}
+SCHEDULE_RUNS_STATE: Dict[str, int] = {"inserts": 0}
+SCHEDULE_HEAP: List[Tuple[float, int, str, str, int]] = []
+SCHEDULE_GENERATIONS: Dict[str, int] = {}
+SCHEDULE_LAST_RUN: Dict[Tuple[str, str], datetime] = {}
+SCHEDULE_EXECUTED: Dict[Tuple[str, str], str] = {}
+SCHEDULE_SEMAPHORES: Dict[str, asyncio.Semaphore] = {}
+SCHEDULE_NODE_LOCKS: Dict[Tuple[str, str], asyncio.Lock] = {}
+SCHEDULE_ACTIVE: Dict[Tuple[str, str], int] = {}
+SCHEDULE_LEASE_RENEWALS: Dict[Tuple[str, str], asyncio.Task] = {}
+SCHEDULE_TASKS: Dict[str, set] = {}
+SCHEDULER_STATE: Dict[str, object] = {"task": None, "wakeup": None, "sequence": 0}
+
+
+class LRUCache:
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max(1, max_size)
+        self.items: OrderedDict = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self.items[key]
+        except KeyError:
+            return default
+        self.items.move_to_end(key)
+        return value
+
+    def set(self, key, value) -> None:
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self.items.pop(key, default)
+
+    def __contains__(self, key) -> bool:
+        return key in self.items
+
+    def clear(self) -> None:
+        self.items.clear()
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, cost: float = 1.0) -> float:
+        now = time.monotonic()
+        self.refill(now)
+        self.tokens -= min(cost, self.capacity)
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(wait, self.blocked_until - now)
+
+    def reserve_now(self, cost: float = 1.0) -> bool:
+        now = time.monotonic()
+        self.refill(now)
+        cost = min(cost, self.capacity)
+        if now < self.blocked_until or self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+    def block(self, seconds: float) -> None:
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def is_idle(self, now: float) -> bool:
+        return now >= self.blocked_until and self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+class OutboundQueue:
+    def __init__(self, bucket: TokenBucket) -> None:
+        self.bucket = bucket
+        self.queues: Dict[str, deque] = {name: deque() for name in SEND_PRIORITY_WEIGHTS}
+        self.credits: Dict[str, int] = {name: 0 for name in SEND_PRIORITY_WEIGHTS}
+        self.wakeup: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def depth(self) -> Dict[str, int]:
+        return {name: len(queue) for name, queue in self.queues.items()}
+
+    def pick(self) -> Optional[str]:
+        ready = [name for name, queue in self.queues.items() if queue]
+        if not ready:
+            return None
+        total = 0
+        for name in ready:
+            self.credits[name] += SEND_PRIORITY_WEIGHTS[name]
+            total += SEND_PRIORITY_WEIGHTS[name]
+        chosen = max(ready, key=lambda name: self.credits[name])
+        self.credits[chosen] -= total
+        return chosen
+
+    async def acquire(self, priority: str, cost: float) -> None:
+        if not any(self.queues.values()) and self.bucket.reserve_now(cost):
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.queues[priority if priority in self.queues else "interactive"].append((future, cost))
+        if self.task is None or self.task.done():
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.create_task(self.run())
+        self.wakeup.set()
+        await future
+
+    async def run(self) -> None:
+        while True:
+            priority = self.pick()
+            if priority is None:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            future, cost = self.queues[priority].popleft()
+            if future.done():
+                continue
+            wait = self.bucket.reserve(cost)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            if not future.done():
+                future.set_result(None)
+
+
+class KeyedExecutor:
+    def __init__(self, limit: int, buffer_size: int) -> None:
+        self.limit = limit
+        self.pending: Dict[object, deque] = {}
+        self.active: set = set()
+        self.ready: deque = deque()
+        self.waiting: set = set()
+        self.capacity = asyncio.Semaphore(buffer_size)
+        self.buffered = 0
+        self.tasks: set = set()
+
+    def stats(self) -> Dict[str, int]:
+        return {"active_chats": len(self.active), "waiting_chats": len(self.ready), "buffered": self.buffered}
+
+    async def submit(self, key, job: Callable) -> None:
+        await self.capacity.acquire()
+        self.buffered += 1
+        self.pending.setdefault(key, deque()).append(job)
+        if key in self.active or key in self.waiting:
+            return
+        if len(self.active) < self.limit:
+            self.start(key)
+        else:
+            self.ready.append(key)
+            self.waiting.add(key)
+
+    def start(self, key) -> None:
+        self.active.add(key)
+        task = asyncio.create_task(self.run(key))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def run(self, key) -> None:
+        try:
+            while True:
+                jobs = self.pending.get(key)
+                if not jobs:
+                    self.pending.pop(key, None)
+                    return
+                job = jobs.popleft()
+                try:
+                    await job()
+                except Exception as exc:
+                    print(f"keyed job failed for {key}: {exc}")
+                finally:
+                    self.buffered -= 1
+                    self.capacity.release()
+                if jobs and self.ready:
+                    self.ready.append(key)
+                    self.waiting.add(key)
+                    return
+        finally:
+            self.active.discard(key)
+            while self.ready and len(self.active) < self.limit:
+                key = self.ready.popleft()
+                self.waiting.discard(key)
+                self.start(key)
+
+
+SEND_PRIORITY: ContextVar[str] = ContextVar("send_priority", default="interactive")
+HTTP_CLIENT_STATE: Dict[str, Optional[AiohttpSession]] = {"session": None, "polling": None}
+TELEGRAM_CLIENTS = LRUCache(TELEGRAM_CLIENT_CACHE_SIZE)
+RATE_LIMITERS: Dict[int, dict] = {}
+TEMPLATE_CACHE = LRUCache(int(os.getenv("BOT_TEMPLATE_CACHE_SIZE", "4096")))
+FILE_ID_CACHE = LRUCache(int(os.getenv("BOT_FILE_ID_CACHE_SIZE", "10000")))
+FILE_ID_WARMED: set[int] = set()
+UPLOAD_NAME_CACHE = LRUCache(int(os.getenv("BOT_UPLOAD_NAME_CACHE_SIZE", "4096")))
+CHAT_USERNAME_CACHE = LRUCache(int(os.getenv("BOT_CHAT_USERNAME_CACHE_SIZE", "4096")))
+CHAT_ADMIN_CACHE_SIZE = int(os.getenv("BOT_CHAT_ADMIN_CACHE_SIZE", "10000"))
+CHAT_ADMIN_CACHE = LRUCache(CHAT_ADMIN_CACHE_SIZE)
+CHAT_TOUCH_CACHE = LRUCache(CHAT_ADMIN_CACHE_SIZE)
+CHAT_TOUCH_INTERVAL_SECONDS = float(os.getenv("BOT_CHAT_TOUCH_INTERVAL", "60"))
+MEMBERSHIP_CACHE = LRUCache(int(os.getenv("BOT_MEMBERSHIP_CACHE_SIZE", "50000")))
+UPLOAD_MANIFEST: Dict[str, dict] = {}
+UPLOAD_MANIFEST_LOCK = threading.Lock()
+UPLOAD_HASH_INDEX: Dict[str, str] = {}
+UPLOAD_UNREGISTERED: set[str] = set()
+
+
+class CompiledFlow:
+    def __init__(self, flow: Flow) -> None:
+        self.nodes_by_id: Dict[str, dict] = {node.get("id"): node for node in flow.nodes}
+        self.edges_by_source: Dict[str, List[dict]] = {}
+        self.edges_by_target: Dict[str, List[dict]] = {}
+        for edge in flow.edges:
+            self.edges_by_source.setdefault(edge.get("source"), []).append(edge)
+            self.edges_by_target.setdefault(edge.get("target"), []).append(edge)
+        self.send_plans: Dict[str, dict] = {}
+        self.markups: Dict[str, object] = {}
+        self.schedules: List[Tuple[str, dict]] = []
+        for node in flow.nodes:
+            config = parse_schedule_node(node)
+            if config and node.get("id"):
+                self.schedules.append((node.get("id"), config))
+
+
+def get_compiled_flow(flow: Flow) -> CompiledFlow:
+    compiled = flow._compiled
+    if compiled is None:
+        compiled = CompiledFlow(flow)
+        flow._compiled = compiled
+    return compiled
 
 
 def get_connection() -> sqlite3.Connection:
@@ -121,6 +480,12 @@ def get_counter_value(bot_id: str, key: str) -> int:
         return int(row["counter_value"]) if row else 0
 
 
+def ensure_column(conn: sqlite3.Connection, table: str, column: str, definition: str) -> None:
+    columns = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})").fetchall()}
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
 def init_db() -> None:
     with get_connection() as conn:
         conn.execute(
@@ -163,6 +528,126 @@ def init_db() -> None:
             )
             """
         )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS media_file_ids (
+                telegram_bot_id INTEGER NOT NULL,
+                content_hash TEXT NOT NULL,
+                media_kind TEXT NOT NULL,
+                file_id TEXT NOT NULL,
+                updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (telegram_bot_id, content_hash, media_kind)
+            )
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS upload_hashes (
+                name TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                content_hash TEXT NOT NULL
+            )
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                id TEXT PRIMARY KEY,
+                bot_id TEXT NOT NULL,
+                status TEXT NOT NULL,
+                message_text TEXT NOT NULL,
+                parse_mode TEXT,
+                status_filter TEXT,
+                total INTEGER DEFAULT 0,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+                job_id TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                state TEXT NOT NULL DEFAULT 'pending',
+                error TEXT,
+                updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (job_id, user_id)
+            )
+            """
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_broadcast_deliveries_state ON broadcast_deliveries (job_id, state)"
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS dead_letters (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                bot_id TEXT NOT NULL,
+                chat_id INTEGER,
+                node_id TEXT,
+                source TEXT,
+                error_kind TEXT NOT NULL,
+                error TEXT,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+            """
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_dead_letters_bot ON dead_letters (bot_id, id)")
+        ensure_column(conn, "user_status", "blocked", "INTEGER DEFAULT 0")
+        ensure_column(conn, "bots", "mode", "TEXT DEFAULT 'auto'")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS bot_polling_state (
+                bot_id TEXT PRIMARY KEY,
+                update_offset INTEGER NOT NULL,
+                updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS schedule_state (
+                bot_id TEXT NOT NULL,
+                node_id TEXT NOT NULL,
+                last_run TEXT,
+                executed INTEGER NOT NULL DEFAULT 0,
+                lease_owner TEXT,
+                lease_until REAL,
+                updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (bot_id, node_id)
+            )
+            """
+        )
+        ensure_column(conn, "schedule_state", "executed_run_at", "TEXT")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS schedule_runs (
+                id TEXT PRIMARY KEY,
+                bot_id TEXT NOT NULL,
+                node_id TEXT NOT NULL,
+                status TEXT NOT NULL,
+                error TEXT,
+                started_at TEXT,
+                finished_at TEXT,
+                duration REAL,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+            """
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_schedule_runs_bot ON schedule_runs (bot_id, created_at)"
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS processed_updates (
+                telegram_bot_id INTEGER NOT NULL,
+                update_id INTEGER NOT NULL,
+                PRIMARY KEY (telegram_bot_id, update_id)
+            )
+            """
+        )
         conn.commit()
 
 
@@ -284,6 +769,7 @@ def row_to_bot(row: sqlite3.Row) -> Bot:
         name=row["name"],
         token=row["token"],
         status=row["status"],
+        mode=row["mode"] if row["mode"] in BOT_MODES else "auto",
         flow=Flow(**flow),
     )
 
@@ -323,8 +809,9 @@ def upsert_user_row(
                 username = excluded.username,
                 first_name = excluded.first_name,
                 last_name = excluded.last_name,
-                photo_file_id = excluded.photo_file_id,
+                photo_file_id = COALESCE(excluded.photo_file_id, user_status.photo_file_id),
                 status = excluded.status,
+                blocked = 0,
                 updated_at = CURRENT_TIMESTAMP
             """,
             (bot_id, user_id, username, first_name, last_name, photo_file_id, status),
@@ -385,7 +872,7 @@ def list_user_entries(bot_id: str) -> List[dict]:
             """
             SELECT user_id, username, first_name, last_name, status
             FROM user_status
-            WHERE bot_id = ?
+            WHERE bot_id = ? AND COALESCE(blocked, 0) = 0
             ORDER BY updated_at DESC
             """,
             (bot_id,),
@@ -480,20 +967,144 @@ async def ensure_user_row(bot_id: str, user: Optional[object], telegram_bot: Opt
     row = get_user_row(bot_id, user_id)
     existing_status = row["status"] if row else ""
     existing_photo = row["photo_file_id"] if row else None
-    photo_file_id = existing_photo
-    if photo_file_id is None and telegram_bot:
-        photo_file_id = await fetch_profile_photo_id(telegram_bot, user_id)
-    if photo_file_id is None:
-        photo_file_id = existing_photo or ""
     upsert_user_row(
         bot_id,
         user_id,
         getattr(user, "username", None),
         getattr(user, "first_name", None),
         getattr(user, "last_name", None),
-        photo_file_id,
+        existing_photo,
         existing_status,
     )
+    if existing_photo is None and telegram_bot:
+        enqueue_profile_photo(bot_id, telegram_bot, user_id)
+
+
+def enqueue_profile_photo(bot_id: str, telegram_bot: TelegramBot, user_id: int) -> None:
+    key = (bot_id, user_id)
+    if key in PROFILE_PHOTO_PENDING:
+        return
+    queue = PROFILE_PHOTO_STATE["queue"]
+    task = PROFILE_PHOTO_STATE["task"]
+    if queue is None or task is None or task.done():
+        queue = asyncio.Queue(maxsize=PROFILE_PHOTO_QUEUE_SIZE)
+        PROFILE_PHOTO_PENDING.clear()
+        PROFILE_PHOTO_STATE["queue"] = queue
+        PROFILE_PHOTO_STATE["task"] = asyncio.create_task(profile_photo_worker(queue))
+    try:
+        queue.put_nowait((bot_id, telegram_bot, user_id))
+    except asyncio.QueueFull:
+        return
+    PROFILE_PHOTO_PENDING.add(key)
+
+
+def store_profile_photos(results: List[Tuple[str, str, int]]) -> None:
+    with get_connection() as conn:
+        conn.executemany(
+            """
+            UPDATE user_status
+            SET photo_file_id = ?
+            WHERE bot_id = ? AND user_id = ? AND photo_file_id IS NULL
+            """,
+            results,
+        )
+        conn.commit()
+
+
+async def profile_photo_worker(queue: asyncio.Queue) -> None:
+    bucket = TokenBucket(PROFILE_PHOTO_RATE, PROFILE_PHOTO_RATE)
+
+    async def resolve(bot_id: str, telegram_bot: TelegramBot, user_id: int) -> Tuple[str, str, int]:
+        wait = bucket.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        photo_file_id = await fetch_profile_photo_id(telegram_bot, user_id)
+        return photo_file_id or "", bot_id, user_id
+
+    while True:
+        batch = [await queue.get()]
+        while len(batch) < PROFILE_PHOTO_BATCH_SIZE and not queue.empty():
+            batch.append(queue.get_nowait())
+        try:
+            results = await asyncio.gather(*(resolve(*item) for item in batch))
+            store_profile_photos(results)
+        except Exception as exc:
+            print(f"profile photo batch failed: {exc}")
+        finally:
+            for bot_id, _, user_id in batch:
+                PROFILE_PHOTO_PENDING.discard((bot_id, user_id))
+
+
+def build_chat_state(chat: object, is_admin: bool) -> dict:
+    return {
+        "is_admin": is_admin,
+        "title": getattr(chat, "title", None),
+        "username": getattr(chat, "username", None),
+        "type": getattr(chat, "type", None),
+    }
+
+
+def touch_chat_row(bot_id: str, chat_id: int) -> None:
+    with get_connection() as conn:
+        conn.execute(
+            "UPDATE bot_chats SET updated_at = CURRENT_TIMESTAMP WHERE bot_id = ? AND chat_id = ?",
+            (bot_id, chat_id),
+        )
+        conn.commit()
+
+
+def remember_chat_state(bot_id: str, chat_id: int, state: dict) -> None:
+    key = (bot_id, chat_id)
+    now = time.monotonic()
+    if CHAT_ADMIN_CACHE.get(key) == state:
+        touched = CHAT_TOUCH_CACHE.get(key)
+        if touched is not None and now - touched < CHAT_TOUCH_INTERVAL_SECONDS:
+            return
+        touch_chat_row(bot_id, chat_id)
+    else:
+        upsert_chat_row(bot_id, chat_id, state["title"], state["username"], state["type"], state["is_admin"])
+        CHAT_ADMIN_CACHE.set(key, state)
+    CHAT_TOUCH_CACHE.set(key, now)
+
+
+def load_chat_state(bot_id: str, chat_id: int) -> Optional[dict]:
+    with get_connection() as conn:
+        row = conn.execute(
+            "SELECT title, username, type, is_admin FROM bot_chats WHERE bot_id = ? AND chat_id = ?",
+            (bot_id, chat_id),
+        ).fetchone()
+    if not row:
+        return None
+    return {
+        "is_admin": bool(row["is_admin"]),
+        "title": row["title"],
+        "username": row["username"],
+        "type": row["type"],
+    }
+
+
+def warm_chat_admin_cache(bot_id: str) -> None:
+    with get_connection() as conn:
+        rows = conn.execute(
+            """
+            SELECT chat_id, title, username, type, is_admin
+            FROM bot_chats
+            WHERE bot_id = ?
+            ORDER BY updated_at DESC
+            LIMIT ?
+            """,
+            (bot_id, CHAT_ADMIN_CACHE_SIZE),
+        ).fetchall()
+    for row in reversed(rows):
+        CHAT_ADMIN_CACHE.set(
+            (bot_id, row["chat_id"]),
+            {
+                "is_admin": bool(row["is_admin"]),
+                "title": row["title"],
+                "username": row["username"],
+                "type": row["type"],
+            },
+        )
 
 
 async def ensure_chat_row(
@@ -501,7 +1112,6 @@ async def ensure_chat_row(
     chat: Optional[object],
     telegram_bot: TelegramBot,
     bot_user_id: int,
-    admin_cache: Dict[int, bool],
 ) -> None:
     if not chat:
         return
@@ -511,25 +1121,31 @@ async def ensure_chat_row(
     chat_id = getattr(chat, "id", None)
     if chat_id is None:
         return
-    is_admin = admin_cache.get(chat_id)
-    if is_admin is None:
+    known = CHAT_ADMIN_CACHE.get((bot_id, chat_id))
+    if known is None:
+        known = load_chat_state(bot_id, chat_id)
+        if known is not None:
+            CHAT_ADMIN_CACHE.set((bot_id, chat_id), known)
+    if known is None:
         try:
             member = await telegram_bot.get_chat_member(chat_id, bot_user_id)
             status = getattr(member, "status", "") or ""
             is_admin = status in ("administrator", "creator")
         except Exception:
             is_admin = False
-        admin_cache[chat_id] = is_admin
-    if not is_admin:
+    else:
+        is_admin = known["is_admin"]
+    remember_chat_state(bot_id, chat_id, build_chat_state(chat, is_admin))
+
+
+def handle_my_chat_member(bot_id: str, update: ChatMemberUpdated) -> None:
+    chat = update.chat
+    status = getattr(update.new_chat_member, "status", "") or ""
+    if chat.type == "private":
+        if status == "kicked":
+            mark_user_blocked(bot_id, chat.id)
         return
-    upsert_chat_row(
-        bot_id,
-        chat_id,
-        getattr(chat, "title", None),
-        getattr(chat, "username", None),
-        chat_type,
-        True,
-    )
+    remember_chat_state(bot_id, chat.id, build_chat_state(chat, status in ("administrator", "creator")))
 
 
 def get_bot_or_404(bot_id: str) -> Bot:
@@ -567,11 +1183,12 @@ def get_webhook_base_url() -> str:
 def update_bot_row(bot: Bot) -> None:
     with get_connection() as conn:
         conn.execute(
-            "UPDATE bots SET name = ?, token = ?, status = ?, flow = ? WHERE id = ?",
+            "UPDATE bots SET name = ?, token = ?, status = ?, mode = ?, flow = ? WHERE id = ?",
             (
                 bot.name,
                 bot.token,
                 bot.status,
+                bot.mode,
                 json.dumps(bot.flow.model_dump()),
                 bot.id,
             ),
@@ -607,6 +1224,110 @@ def get_text_path(bot_id: str, name: str) -> str:
     return os.path.join(TEXT_DIR, f"{sanitize_filename(bot_id)}__{filename}")
 
 
+TEMPLATE_FIELDS = {
+    "text",
+    "name",
+    "first_name",
+    "last_name",
+    "username",
+    "chat_id",
+    "full_name",
+    "message_id",
+    "photo_id",
+    "video_id",
+    "audio_id",
+    "voice_id",
+    "document_id",
+    "sticker_id",
+    "contact_phone",
+    "location_lat",
+    "location_lon",
+    "date",
+    "time",
+}
+TEMPLATE_PLACEHOLDER_PATTERN = re.compile(r"\{(?:row\[([^\]]+)\]|var\.([^{}]+)|([a-z_]+))\}")
+
+
+def compile_template(text: str) -> tuple:
+    tokens = TEMPLATE_CACHE.get(text)
+    if tokens is not None:
+        return tokens
+    parts: list = []
+    position = 0
+    for match in TEMPLATE_PLACEHOLDER_PATTERN.finditer(text):
+        row_key, var_key, field = match.groups()
+        if field is not None and field not in TEMPLATE_FIELDS:
+            continue
+        if match.start() > position:
+            parts.append(text[position:match.start()])
+        if row_key is not None:
+            parts.append(("row", row_key.strip().lower(), match.group(0)))
+        elif var_key is not None:
+            parts.append(("var", var_key, match.group(0)))
+        else:
+            parts.append(("field", field, match.group(0)))
+        position = match.end()
+    if parts and position < len(text):
+        parts.append(text[position:])
+    tokens = tuple(parts)
+    TEMPLATE_CACHE.set(text, tokens)
+    return tokens
+
+
+def resolve_template_field(field: str, context: dict) -> str:
+    message = context.get("message")
+    source = context.get("user")
+    if field in ("name", "first_name"):
+        return (getattr(source, "first_name", "") if source else "") or ""
+    if field == "last_name":
+        return (getattr(source, "last_name", "") if source else "") or ""
+    if field == "username":
+        username = (getattr(source, "username", "") if source else "") or ""
+        return f"@{username}" if username else ""
+    if field == "full_name":
+        first_name = getattr(source, "first_name", "") if source else ""
+        last_name = getattr(source, "last_name", "") if source else ""
+        return " ".join(part for part in [first_name, last_name] if part)
+    if field == "chat_id":
+        chat_id = context.get("chat_id")
+        if chat_id is None:
+            chat = getattr(message, "chat", None)
+            chat_id = chat.id if chat else ""
+        return str(chat_id)
+    if field in ("date", "time"):
+        now = context.get("now")
+        if now is None:
+            now = context["now"] = datetime.now()
+        return now.strftime("%Y-%m-%d" if field == "date" else "%H:%M:%S")
+    if not message:
+        return ""
+    if field == "text":
+        return ((getattr(message, "text", "") or getattr(message, "caption", "")) or "").strip()
+    if field == "message_id":
+        return str(getattr(message, "message_id", ""))
+    if field == "photo_id":
+        if getattr(message, "photo", None):
+            try:
+                return str(message.photo[-1].file_id)
+            except Exception:
+                return ""
+        return ""
+    if field in ("video_id", "audio_id", "voice_id", "document_id", "sticker_id"):
+        attachment = getattr(message, field[:-3], None)
+        return str(getattr(attachment, "file_id", "") or "")
+    if field == "contact_phone":
+        return str(getattr(getattr(message, "contact", None), "phone_number", "") or "")
+    if field in ("location_lat", "location_lon"):
+        location = getattr(message, "location", None)
+        if not location:
+            return ""
+        try:
+            return str(location.latitude if field == "location_lat" else location.longitude)
+        except Exception:
+            return ""
+    return ""
+
+
 def render_template(
     text: str,
     message: Message,
@@ -617,101 +1338,45 @@ def render_template(
 ) -> str:
     if not text:
         return ""
-    now = datetime.now()
-    current_date = now.strftime("%Y-%m-%d")
-    current_time = now.strftime("%H:%M:%S")
-    source = user or (getattr(message, "from_user", None) if message else None)
-    first_name = getattr(source, "first_name", "") if source else ""
-    last_name = getattr(source, "last_name", "") if source else ""
-    username = getattr(source, "username", "") if source else ""
-    incoming_text = ((getattr(message, "text", "") or getattr(message, "caption", "")) or "").strip() if message else ""
-    message_id = getattr(message, "message_id", "") if message else ""
-    photo_id = ""
-    if message and getattr(message, "photo", None):
-        try:
-            photo_id = message.photo[-1].file_id
-        except Exception:
-            photo_id = ""
-    video_id = getattr(getattr(message, "video", None), "file_id", "") if message else ""
-    audio_id = getattr(getattr(message, "audio", None), "file_id", "") if message else ""
-    voice_id = getattr(getattr(message, "voice", None), "file_id", "") if message else ""
-    document_id = getattr(getattr(message, "document", None), "file_id", "") if message else ""
-    sticker_id = getattr(getattr(message, "sticker", None), "file_id", "") if message else ""
-    contact_phone = getattr(getattr(message, "contact", None), "phone_number", "") if message else ""
-    location_lat = ""
-    location_lon = ""
-    if message and getattr(message, "location", None):
-        try:
-            location_lat = str(message.location.latitude)
-            location_lon = str(message.location.longitude)
-        except Exception:
-            location_lat = ""
-            location_lon = ""
-    if chat_id_override is not None:
-        chat_id = chat_id_override
-    else:
-        chat = getattr(message, "chat", None)
-        chat_id = chat.id if chat else ""
-    replacements = {
-        "{text}": incoming_text,
-        "{name}": first_name,
-        "{first_name}": first_name,
-        "{last_name}": last_name,
-        "{username}": f"@{username}" if username else "",
-        "{chat_id}": str(chat_id),
-        "{full_name}": " ".join(part for part in [first_name, last_name] if part),
-        "{message_id}": str(message_id),
-        "{photo_id}": str(photo_id),
-        "{video_id}": str(video_id),
-        "{audio_id}": str(audio_id),
-        "{voice_id}": str(voice_id),
-        "{document_id}": str(document_id),
-        "{sticker_id}": str(sticker_id),
-        "{contact_phone}": str(contact_phone),
-        "{location_lat}": str(location_lat),
-        "{location_lon}": str(location_lon),
-        "{date}": current_date,
-        "{time}": current_time,
+    tokens = compile_template(text)
+    if not tokens:
+        return text
+    context = {
+        "message": message,
+        "user": user or (getattr(message, "from_user", None) if message else None),
+        "chat_id": chat_id_override,
     }
-    result = text
-    for key, value in replacements.items():
-        result = result.replace(key, value)
-    if row_data:
-        lower_map = {str(key).lower(): str(value) for key, value in row_data.items() if value is not None}
-        def replace_row(match: re.Match) -> str:
-            key = match.group(1).strip().lower()
-            return lower_map.get(key, "")
-        result = re.sub(r"\{row\[([^\]]+)\]\}", replace_row, result)
-    if extra_vars:
-        safe_vars = {str(key): "" if value is None else str(value) for key, value in extra_vars.items()}
-        for key, value in safe_vars.items():
-            result = result.replace(f"{{var.{key}}}", value)
-    return result
+    row_map: Optional[dict] = None
+    parts: List[str] = []
+    for token in tokens:
+        if isinstance(token, str):
+            parts.append(token)
+            continue
+        kind, key, literal = token
+        if kind == "field":
+            parts.append(resolve_template_field(key, context))
+        elif kind == "row":
+            if not row_data:
+                parts.append(literal)
+                continue
+            if row_map is None:
+                row_map = {str(name).lower(): str(value) for name, value in row_data.items() if value is not None}
+            parts.append(row_map.get(key, ""))
+        elif extra_vars and key in extra_vars:
+            value = extra_vars[key]
+            parts.append("" if value is None else str(value))
+        else:
+            parts.append(literal)
+    return "".join(parts)
+
+
+HTML_PARSE_MODE_PATTERN = re.compile(r"</?(?:b|strong|i|em|u|s|code|pre)>|<a ", re.IGNORECASE)
 
 
 def detect_parse_mode(text: str) -> Optional[ParseMode]:
     if not text:
         return None
-    lowered = text.lower()
-    if (
-        "<b>" in lowered
-        or "</b>" in lowered
-        or "<strong>" in lowered
-        or "</strong>" in lowered
-        or "<i>" in lowered
-        or "</i>" in lowered
-        or "<em>" in lowered
-        or "</em>" in lowered
-        or "<u>" in lowered
-        or "</u>" in lowered
-        or "<s>" in lowered
-        or "</s>" in lowered
-        or "<code>" in lowered
-        or "</code>" in lowered
-        or "<pre>" in lowered
-        or "</pre>" in lowered
-        or "<a " in lowered
-    ):
+    if HTML_PARSE_MODE_PATTERN.search(text):
         return ParseMode.HTML
     return None
 
@@ -776,6 +1441,123 @@ def parse_schedule_node(node: dict) -> Optional[dict]:
     if data.get("pluginKind") != "plugin_schedule":
         return None
     values = data.get("pluginValues") or {}
+    config = parse_schedule_values(values)
+    if config is None:
+        return None
+    missed = str(values.get("missedPolicy") or "").strip().lower()
+    if missed not in SCHEDULE_MISSED_POLICIES:
+        missed = SCHEDULE_MISSED_POLICY
+    config["missed"] = missed
+    overrun = str(values.get("overrunPolicy") or "").strip().lower()
+    if overrun not in SCHEDULE_OVERRUN_POLICIES:
+        overrun = SCHEDULE_OVERRUN_POLICY
+    config["overrun"] = overrun
+    config["zone"] = resolve_schedule_zone(values.get("timezone"))
+    return config
+
+
+def resolve_schedule_zone(value: Optional[str]) -> Optional[ZoneInfo]:
+    name = str(value or "").strip() or SCHEDULE_TIMEZONE
+    if not name:
+        return None
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        return None
+
+
+def parse_cron_field(raw: str, index: int) -> Optional[set[int]]:
+    low, high = CRON_FIELDS[index]
+    names = CRON_NAMES[index]
+    values: set[int] = set()
+    for part in raw.lower().split(","):
+        step = 1
+        if "/" in part:
+            part, raw_step = part.split("/", 1)
+            if not raw_step.isdigit() or int(raw_step) <= 0:
+                return None
+            step = int(raw_step)
+        if part == "*":
+            start, end = low, high
+        else:
+            try:
+                bounds = [names[item] if item in names else int(item) for item in part.split("-", 1)]
+            except ValueError:
+                return None
+            start = bounds[0]
+            end = bounds[1] if len(bounds) > 1 else (high if step > 1 else start)
+        if start < low or end > (7 if index == 4 else high) or start > end:
+            return None
+        values.update(value % 7 if index == 4 else value for value in range(start, end + 1, step))
+    return values
+
+
+def parse_cron_expression(raw: str) -> Optional[dict]:
+    expression = CRON_MACROS.get(raw.strip().lower(), raw.strip())
+    fields = expression.split()
+    if len(fields) != 5:
+        return None
+    sets = [parse_cron_field(field, index) for index, field in enumerate(fields)]
+    if any(not item for item in sets):
+        return None
+    return {
+        "minutes": sorted(sets[0]),
+        "hours": sorted(sets[1]),
+        "days": sets[2],
+        "months": sets[3],
+        "weekdays": sets[4],
+        "any_day": fields[2].startswith("*"),
+        "any_weekday": fields[4].startswith("*"),
+    }
+
+
+def cron_day_matches(cron: dict, day: datetime) -> bool:
+    day_match = day.day in cron["days"]
+    weekday_match = (day.weekday() + 1) % 7 in cron["weekdays"]
+    if cron["any_day"] or cron["any_weekday"]:
+        return day_match and weekday_match
+    return day_match or weekday_match
+
+
+def next_cron_time(cron: dict, after: datetime) -> Optional[datetime]:
+    candidate = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+    limit = candidate + timedelta(days=366 * 5)
+    while candidate < limit:
+        if candidate.month not in cron["months"]:
+            year = candidate.year + (1 if candidate.month == 12 else 0)
+            month = 1 if candidate.month == 12 else candidate.month + 1
+            candidate = candidate.replace(year=year, month=month, day=1, hour=0, minute=0)
+            continue
+        if not cron_day_matches(cron, candidate):
+            candidate = candidate.replace(hour=0, minute=0) + timedelta(days=1)
+            continue
+        hour = next((item for item in cron["hours"] if item >= candidate.hour), None)
+        if hour is None:
+            candidate = candidate.replace(hour=0, minute=0) + timedelta(days=1)
+            continue
+        if hour != candidate.hour:
+            candidate = candidate.replace(hour=hour, minute=0)
+        minute = next((item for item in cron["minutes"] if item >= candidate.minute), None)
+        if minute is None:
+            candidate = candidate.replace(minute=0) + timedelta(hours=1)
+            continue
+        return candidate.replace(minute=minute)
+    return None
+
+
+def to_zone_time(value: datetime, zone: Optional[ZoneInfo]) -> datetime:
+    if zone is None:
+        return value
+    return value.astimezone(zone).replace(tzinfo=None)
+
+
+def from_zone_time(value: datetime, zone: Optional[ZoneInfo]) -> datetime:
+    if zone is None:
+        return value
+    return value.replace(tzinfo=zone).astimezone().replace(tzinfo=None)
+
+
+def parse_schedule_values(values: dict) -> Optional[dict]:
     schedule_type = (values.get("scheduleType") or "interval").strip()
     if schedule_type == "interval":
         raw = values.get("intervalSeconds") or "60"
@@ -806,6 +1588,12 @@ def parse_schedule_node(node: dict) -> Optional[dict]:
         except Exception:
             return None
         return {"type": "datetime", "run_at": run_at}
+    if schedule_type == "cron":
+        raw_cron = str(values.get("cronExpression") or "").strip()
+        cron = parse_cron_expression(raw_cron) if raw_cron else None
+        if cron is None:
+            return None
+        return {"type": "cron", "cron": cron}
     return None
 
 
@@ -847,6 +1635,7 @@ async def run_plugin_node(
         "variables": variables,
         "row": row_data,
         "render": render,
+        "broadcast": build_broadcast_starter(bot_id) if bot_id else None,
     }
     try:
         result = handler(payload)
@@ -865,18 +1654,7 @@ async def run_plugin_node(
     return value
 
 
-async def is_user_subscribed(telegram_bot: TelegramBot, chat_id: object, user_id: int) -> bool:
-    try:
-        resolved_chat_id = chat_id
-        if isinstance(chat_id, str):
-            try:
-                chat = await telegram_bot.get_chat(chat_id)
-                resolved_chat_id = chat.id
-            except Exception:
-                return False
-        member = await telegram_bot.get_chat_member(resolved_chat_id, user_id)
-    except Exception:
-        return False
+def is_member_status(member: object) -> bool:
     status = getattr(member, "status", "") or ""
     if status in ("creator", "administrator", "member"):
         return True
@@ -885,6 +1663,45 @@ async def is_user_subscribed(telegram_bot: TelegramBot, chat_id: object, user_id
     return False
 
 
+async def resolve_subscription_chat_id(telegram_bot: TelegramBot, chat_id: object) -> Optional[int]:
+    if not isinstance(chat_id, str):
+        return chat_id
+    key = (telegram_bot.id, chat_id.lower())
+    resolved = CHAT_USERNAME_CACHE.get(key)
+    if resolved is None:
+        try:
+            chat = await telegram_bot.get_chat(chat_id)
+        except Exception:
+            return None
+        resolved = chat.id
+        CHAT_USERNAME_CACHE.set(key, resolved)
+    return resolved
+
+
+def remember_membership(telegram_bot_id: int, chat_id: int, user_id: int, is_member: bool) -> None:
+    ttl = MEMBERSHIP_TTL_SECONDS if is_member else MEMBERSHIP_NEGATIVE_TTL_SECONDS
+    if ttl > 0:
+        MEMBERSHIP_CACHE.set((telegram_bot_id, chat_id, user_id), (time.monotonic() + ttl, is_member))
+
+
+async def is_user_subscribed(telegram_bot: TelegramBot, chat_id: object, user_id: int) -> bool:
+    resolved_chat_id = await resolve_subscription_chat_id(telegram_bot, chat_id)
+    if resolved_chat_id is None:
+        return False
+    key = (telegram_bot.id, resolved_chat_id, user_id)
+    cached = MEMBERSHIP_CACHE.get(key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    try:
+        member = await telegram_bot.get_chat_member(resolved_chat_id, user_id)
+    except Exception as exc:
+        print(f"membership check failed for chat {resolved_chat_id}: {exc}")
+        return False
+    is_member = is_member_status(member)
+    remember_membership(telegram_bot.id, resolved_chat_id, user_id, is_member)
+    return is_member
+
+
 def match_condition(message: Message, node: dict, bot_id: Optional[str] = None, user_id: Optional[int] = None) -> bool:
     data = node.get("data", {})
     text_value = (message.text or message.caption or "").strip()
@@ -1585,128 +2402,110 @@ async def collect_scheduled_targets(
     return results
 
 
-async def send_images_via_bot(
+MEDIA_SEND_METHODS = {
+    "image": ("send_photo", InputMediaPhoto),
+    "video": ("send_video", InputMediaVideo),
+    "audio": ("send_audio", InputMediaAudio),
+    "document": ("send_document", InputMediaDocument),
+}
+
+
+async def deliver_media(
     telegram_bot: TelegramBot,
     chat_id: int,
-    urls: List[str],
-    caption: str = "",
-    reply_markup=None,
-    parse_mode: Optional[str] = None,
-) -> bool:
-    sources = [resolve_upload_source(url) for url in urls]
-    sources = [source for source in sources if source]
-    if not sources:
-        return False
-    if len(sources) == 1:
-        await telegram_bot.send_photo(
+    kind: str,
+    items: list,
+    caption: str,
+    reply_markup,
+    parse_mode: Optional[str],
+    send_kwargs: dict,
+) -> list:
+    method_name, media_type = MEDIA_SEND_METHODS[kind]
+    if len(items) == 1:
+        sent = await getattr(telegram_bot, method_name)(
             chat_id,
-            sources[0],
+            items[0],
             caption=caption or None,
             reply_markup=reply_markup,
             parse_mode=parse_mode,
+            **send_kwargs,
         )
-        return True
+        return [sent]
     media = []
-    for idx, source in enumerate(sources):
+    for idx, item in enumerate(items):
         if idx == 0 and caption:
-            media.append(InputMediaPhoto(media=source, caption=caption))
+            media.append(media_type(media=item, caption=caption))
         else:
-            media.append(InputMediaPhoto(media=source))
-    await telegram_bot.send_media_group(chat_id, media)
-    return True
+            media.append(media_type(media=item))
+    return list(await telegram_bot.send_media_group(chat_id, media, **send_kwargs) or [])
 
 
-async def send_videos_via_bot(
+async def send_media_via_bot(
     telegram_bot: TelegramBot,
     chat_id: int,
-    urls: List[str],
+    kind: str,
+    sources: list,
     caption: str = "",
     reply_markup=None,
     parse_mode: Optional[str] = None,
-) -> bool:
-    sources = [resolve_upload_source(url) for url in urls]
-    sources = [source for source in sources if source]
+    **send_kwargs,
+) -> list:
     if not sources:
-        return False
-    if len(sources) == 1:
-        await telegram_bot.send_video(
-            chat_id,
-            sources[0],
-            caption=caption or None,
-            reply_markup=reply_markup,
-            parse_mode=parse_mode,
-        )
-        return True
-    media = []
-    for idx, source in enumerate(sources):
-        if idx == 0 and caption:
-            media.append(InputMediaVideo(media=source, caption=caption))
-        else:
-            media.append(InputMediaVideo(media=source))
-    await telegram_bot.send_media_group(chat_id, media)
-    return True
+        return []
+    cache_keys = [get_file_id_cache_key(telegram_bot, kind, source) for source in sources]
+    cached_ids = [get_cached_file_id(key) if key else None for key in cache_keys]
+    items = [file_id or source for file_id, source in zip(cached_ids, sources)]
+    try:
+        sent = await deliver_media(telegram_bot, chat_id, kind, items, caption, reply_markup, parse_mode, send_kwargs)
+    except TelegramBadRequest as exc:
+        if not any(cached_ids) or not is_stale_file_id_error(exc):
+            raise
+        for key, file_id in zip(cache_keys, cached_ids):
+            if file_id:
+                forget_file_id(key)
+        cached_ids = [None] * len(sources)
+        sent = await deliver_media(telegram_bot, chat_id, kind, sources, caption, reply_markup, parse_mode, send_kwargs)
+    for key, file_id, sent_message in zip(cache_keys, cached_ids, sent):
+        if not key or file_id:
+            continue
+        new_file_id = extract_sent_file_id(sent_message, kind)
+        if new_file_id:
+            remember_file_id(key, new_file_id)
+    return sent
 
 
-async def send_audios_via_bot(
+async def send_planned_content(
     telegram_bot: TelegramBot,
     chat_id: int,
-    urls: List[str],
-    caption: str = "",
-    reply_markup=None,
+    plan: dict,
+    message_text: str,
     parse_mode: Optional[str] = None,
-) -> bool:
-    sources = [resolve_upload_source(url) for url in urls]
-    sources = [source for source in sources if source]
-    if not sources:
-        return False
-    if len(sources) == 1:
-        await telegram_bot.send_audio(
+    **send_kwargs,
+) -> None:
+    reply_markup = plan["reply_markup"]
+    caption_used = False
+    for kind, sources in plan["media"]:
+        caption = message_text if message_text and not caption_used else ""
+        await send_media_via_bot(
+            telegram_bot,
             chat_id,
-            sources[0],
-            caption=caption or None,
-            reply_markup=reply_markup,
-            parse_mode=parse_mode,
+            kind,
+            sources,
+            caption=caption,
+            reply_markup=reply_markup if not caption_used else None,
+            parse_mode=parse_mode if caption else None,
+            **send_kwargs,
         )
-        return True
-    media = []
-    for idx, source in enumerate(sources):
-        if idx == 0 and caption:
-            media.append(InputMediaAudio(media=source, caption=caption))
-        else:
-            media.append(InputMediaAudio(media=source))
-    await telegram_bot.send_media_group(chat_id, media)
-    return True
-
-
-async def send_documents_via_bot(
-    telegram_bot: TelegramBot,
-    chat_id: int,
-    urls: List[str],
-    caption: str = "",
-    reply_markup=None,
-    parse_mode: Optional[str] = None,
-) -> bool:
-    sources = [resolve_upload_source(url) for url in urls]
-    sources = [source for source in sources if source]
-    if not sources:
-        return False
-    if len(sources) == 1:
-        await telegram_bot.send_document(
+        if caption:
+            caption_used = True
+    if not plan["media"] and message_text:
+        await telegram_bot.send_message(
             chat_id,
-            sources[0],
-            caption=caption or None,
+            message_text,
             reply_markup=reply_markup,
             parse_mode=parse_mode,
+            **send_kwargs,
         )
-        return True
-    media = []
-    for idx, source in enumerate(sources):
-        if idx == 0 and caption:
-            media.append(InputMediaDocument(media=source, caption=caption))
-        else:
-            media.append(InputMediaDocument(media=source))
-    await telegram_bot.send_media_group(chat_id, media)
-    return True
 
 
 async def send_content_node_to_chat(
@@ -1718,13 +2517,11 @@ async def send_content_node_to_chat(
     row_data: Optional[dict] = None,
     extra_vars: Optional[dict] = None,
 ) -> None:
-    payload = target_node.get("data", {})
-    kind = payload.get("kind")
-    if kind == "delete_message":
+    if target_node.get("data", {}).get("kind") == "delete_message":
         return
-    is_edit = kind == "edit_message"
-    if kind == "message" or is_edit:
-        raw_text = payload.get("editMessageText") if is_edit else payload.get("messageText")
+    plan = get_send_plan(flow, target_node)
+    message_text = ""
+    if plan["text"]:
         fake_message = type("Obj", (), {"chat": type("Obj", (), {"id": chat_id})()})()
         user_obj = None
         if entry:
@@ -1739,107 +2536,22 @@ async def send_content_node_to_chat(
                 },
             )()
         message_text = render_template(
-            (raw_text or "").strip(),
+            plan["text"],
             fake_message,
             user_obj,
             chat_id,
             row_data=row_data,
             extra_vars=extra_vars,
         )
-        parse_mode = detect_parse_mode(message_text)
-        image_urls = collect_image_urls(flow, target_node.get("id") or "")
-        video_urls = collect_video_urls(flow, target_node.get("id") or "")
-        audio_urls = collect_audio_urls(flow, target_node.get("id") or "")
-        document_urls = collect_document_urls(flow, target_node.get("id") or "")
-        reply_markup = build_reply_markup(flow, target_node.get("id") or "")
-        caption_used = False
-        reply_used = False
-        if image_urls:
-            caption = message_text if message_text and not caption_used else ""
-            await send_images_via_bot(
-                telegram_bot,
-                chat_id,
-                image_urls,
-                caption=caption,
-                reply_markup=reply_markup if not reply_used else None,
-                parse_mode=parse_mode if caption else None,
-            )
-            if caption:
-                caption_used = True
-                reply_used = True
-        if video_urls:
-            caption = message_text if message_text and not caption_used else ""
-            await send_videos_via_bot(
-                telegram_bot,
-                chat_id,
-                video_urls,
-                caption=caption,
-                reply_markup=reply_markup if not reply_used else None,
-                parse_mode=parse_mode if caption else None,
-            )
-            if caption:
-                caption_used = True
-                reply_used = True
-        if audio_urls:
-            caption = message_text if message_text and not caption_used else ""
-            await send_audios_via_bot(
-                telegram_bot,
-                chat_id,
-                audio_urls,
-                caption=caption,
-                reply_markup=reply_markup if not reply_used else None,
-                parse_mode=parse_mode if caption else None,
-            )
-            if caption:
-                caption_used = True
-                reply_used = True
-        if document_urls:
-            caption = message_text if message_text and not caption_used else ""
-            await send_documents_via_bot(
-                telegram_bot,
-                chat_id,
-                document_urls,
-                caption=caption,
-                reply_markup=reply_markup if not reply_used else None,
-                parse_mode=parse_mode if caption else None,
-            )
-            if caption:
-                caption_used = True
-                reply_used = True
-        if not (image_urls or video_urls or audio_urls or document_urls):
-            if message_text:
-                await telegram_bot.send_message(
-                    chat_id,
-                    message_text,
-                    reply_markup=reply_markup,
-                    parse_mode=parse_mode,
-                )
-        return
-    if kind == "image":
-        urls = payload.get("imageUrls") or []
-        reply_markup = build_reply_markup(flow, target_node.get("id") or "")
-        await send_images_via_bot(telegram_bot, chat_id, urls, reply_markup=reply_markup)
-        return
-    if kind == "video":
-        urls = payload.get("videoUrls") or []
-        reply_markup = build_reply_markup(flow, target_node.get("id") or "")
-        await send_videos_via_bot(telegram_bot, chat_id, urls, reply_markup=reply_markup)
-        return
-    if kind == "audio":
-        urls = payload.get("audioUrls") or []
-        reply_markup = build_reply_markup(flow, target_node.get("id") or "")
-        await send_audios_via_bot(telegram_bot, chat_id, urls, reply_markup=reply_markup)
-        return
-    if kind == "document":
-        urls = payload.get("documentUrls") or []
-        reply_markup = build_reply_markup(flow, target_node.get("id") or "")
-        await send_documents_via_bot(telegram_bot, chat_id, urls, reply_markup=reply_markup)
+    parse_mode = plan["parse_mode"] if message_text == plan["text"] else detect_parse_mode(message_text)
+    await send_planned_content(telegram_bot, chat_id, plan, message_text, parse_mode)
 
 
 async def send_scheduled_targets_with_delay(
     flow: Flow,
     telegram_bot: TelegramBot,
     targets: List[Tuple[dict, float, int, Optional[dict], Optional[dict], Optional[dict]]],
+    bot_id: Optional[str] = None,
 ) -> None:
     if not targets:
         return
@@ -1853,7 +2565,7 @@ async def send_scheduled_targets_with_delay(
         try:
             await send_content_node_to_chat(flow, telegram_bot, chat_id, target_node, entry, row_data, extra_vars)
         except Exception as exc:
-            print(f"send_content_node_to_chat failed for chat {chat_id}: {exc}")
+            handle_send_failure(bot_id, chat_id, target_node.get("id"), "scheduled", exc)
 
 
 def find_reply_button_by_text(flow: Flow, text: str) -> Optional[dict]:
@@ -1871,11 +2583,11 @@ def find_reply_button_by_text(flow: Flow, text: str) -> Optional[dict]:
 
 
 def collect_button_rows(flow: Flow, content_node_id: str) -> Tuple[List[List[dict]], List[List[dict]]]:
-    nodes_by_id = {node.get("id"): node for node in flow.nodes}
-    row_edges = [edge for edge in flow.edges if edge.get("source") == content_node_id]
+    compiled = get_compiled_flow(flow)
+    nodes_by_id = compiled.nodes_by_id
     row_nodes = []
     direct_buttons = []
-    for edge in row_edges:
+    for edge in compiled.edges_by_source.get(content_node_id, []):
         target_node = nodes_by_id.get(edge.get("target"))
         if not target_node:
             continue
@@ -1892,8 +2604,7 @@ def collect_button_rows(flow: Flow, content_node_id: str) -> Tuple[List[List[dic
         for row_node in row_nodes:
             row_buttons = [
                 nodes_by_id.get(edge.get("target"))
-                for edge in flow.edges
-                if edge.get("source") == row_node.get("id")
+                for edge in compiled.edges_by_source.get(row_node.get("id"), [])
             ]
             row_buttons = [btn for btn in row_buttons if btn]
             inline = [btn for btn in row_buttons if btn.get("data", {}).get("kind") == "message_button"]
@@ -1914,12 +2625,20 @@ def collect_button_rows(flow: Flow, content_node_id: str) -> Tuple[List[List[dic
 
 
 def build_reply_markup(flow: Flow, content_node_id: str):
-    nodes_by_id = {node.get("id"): node for node in flow.nodes}
+    compiled = get_compiled_flow(flow)
+    if content_node_id in compiled.markups:
+        return compiled.markups[content_node_id]
+    markup = create_reply_markup(flow, content_node_id)
+    compiled.markups[content_node_id] = markup
+    return markup
+
+
+def create_reply_markup(flow: Flow, content_node_id: str):
+    compiled = get_compiled_flow(flow)
     inline_rows, reply_rows = collect_button_rows(flow, content_node_id)
     has_clear = any(
-        nodes_by_id.get(edge.get("target"), {}).get("data", {}).get("kind") == "reply_clear"
-        for edge in flow.edges
-        if edge.get("source") == content_node_id
+        compiled.nodes_by_id.get(edge.get("target"), {}).get("data", {}).get("kind") == "reply_clear"
+        for edge in compiled.edges_by_source.get(content_node_id, [])
     )
 
     def build_inline_button(btn: dict) -> Optional[InlineKeyboardButton]:
@@ -1985,39 +2704,172 @@ def build_reply_markup(flow: Flow, content_node_id: str):
     return None
 
 
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+UPLOAD_TMP_DIR = os.path.join(UPLOAD_DIR, ".tmp")
+CONTENT_HASH_PATTERN = re.compile(r"[0-9a-f]{64}")
+UPLOAD_EXTENSION_PATTERN = re.compile(r"\.[a-z0-9]{1,10}")
+
+
+def get_upload_extension(filename: Optional[str], default: str) -> str:
+    ext = os.path.splitext(filename or "")[1].lower()
+    return ext if UPLOAD_EXTENSION_PATTERN.fullmatch(ext) else default
+
+
+def get_content_address(content_hash: str, ext: str) -> str:
+    return f"{content_hash[:2]}/{content_hash[2:4]}/{content_hash}{ext}"
+
+
+def find_stored_upload(content_hash: str) -> Optional[str]:
+    name = UPLOAD_HASH_INDEX.get(content_hash)
+    if name:
+        return name
+    shard = os.path.join(UPLOAD_DIR, content_hash[:2], content_hash[2:4])
+    try:
+        names = os.listdir(shard)
+    except OSError:
+        return None
+    for name in sorted(names):
+        if os.path.splitext(name)[0] == content_hash:
+            return f"{content_hash[:2]}/{content_hash[2:4]}/{name}"
+    return None
+
+
+async def store_upload(upload: UploadFile, default_ext: str) -> str:
+    ext = get_upload_extension(upload.filename, default_ext)
+    digest = hashlib.sha256()
+    os.makedirs(UPLOAD_TMP_DIR, exist_ok=True)
+    tmp_path = os.path.join(UPLOAD_TMP_DIR, uuid.uuid4().hex)
+    try:
+        with open(tmp_path, "wb") as file_obj:
+            while True:
+                chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                file_obj.write(chunk)
+        content_hash = digest.hexdigest()
+        existing = find_stored_upload(content_hash)
+        if existing:
+            try:
+                os.utime(os.path.join(UPLOAD_DIR, existing))
+            except OSError:
+                pass
+            if existing not in UPLOAD_MANIFEST:
+                register_upload(existing, content_hash)
+            return f"/uploads/{existing}"
+        name = get_content_address(content_hash, ext)
+        path = os.path.join(UPLOAD_DIR, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+        register_upload(name, content_hash)
+        return f"/uploads/{name}"
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
 @app.post("/uploads/images")
 async def upload_images(files: List[UploadFile] = File(...)) -> dict:
-    urls: List[str] = []
-    for upload in files:
-        ext = os.path.splitext(upload.filename or "")[1].lower() or ".jpg"
-        name = f"{uuid.uuid4().hex}{ext}"
-        path = os.path.join(UPLOAD_DIR, name)
-        content = await upload.read()
-        with open(path, "wb") as file_obj:
-            file_obj.write(content)
-        urls.append(f"/uploads/{name}")
-    return {"urls": urls}
+    return {"urls": [await store_upload(upload, ".jpg") for upload in files]}
 
 
-app.mount("/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
+@app.post("/uploads/videos")
+async def upload_videos(files: List[UploadFile] = File(...)) -> dict:
+    return {"urls": [await store_upload(upload, ".mp4") for upload in files]}
 
 
-def collect_media_urls(flow: Flow, source_id: str, kind: str) -> List[str]:
-    field_map = {
-        "image": "imageUrls",
-        "video": "videoUrls",
-        "audio": "audioUrls",
-        "document": "documentUrls",
+@app.post("/uploads/audios")
+async def upload_audios(files: List[UploadFile] = File(...)) -> dict:
+    return {"urls": [await store_upload(upload, ".mp3") for upload in files]}
+
+
+@app.post("/uploads/documents")
+async def upload_documents(files: List[UploadFile] = File(...)) -> dict:
+    return {"urls": [await store_upload(upload, "") for upload in files]}
+
+
+def lookup_upload_entry(name: str) -> Optional[dict]:
+    return UPLOAD_MANIFEST.get(name)
+
+
+def get_unindexed_upload(name: str) -> Optional[dict]:
+    if not name or name.split("/", 1)[0].startswith("."):
+        return None
+    path = os.path.join(os.path.abspath(UPLOAD_DIR), name)
+    if not os.path.isfile(path):
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    stem = os.path.splitext(os.path.basename(name))[0]
+    content_hash = stem if CONTENT_HASH_PATTERN.fullmatch(stem) else ""
+    source = FSInputFile(path)
+    source.content_hash = content_hash or None
+    return {
+        "name": name,
+        "path": path,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "hash": content_hash,
+        "mime": mimetypes.guess_type(name)[0] or "application/octet-stream",
+        "source": source,
     }
-    field = field_map.get(kind)
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+def build_sendfile_response(entry: dict, headers: dict) -> Response:
+    if UPLOAD_SENDFILE_HEADER.lower() == "x-accel-redirect":
+        target = UPLOAD_SENDFILE_PREFIX.rstrip("/") + "/" + entry["name"]
+    else:
+        target = os.path.abspath(entry["path"])
+    headers[UPLOAD_SENDFILE_HEADER] = target
+    return Response(headers=headers, media_type=entry["mime"])
+
+
+@app.api_route("/uploads/{name:path}", methods=["GET", "HEAD"])
+def serve_upload(name: str, request: Request) -> Response:
+    name = normalize_upload_name(name)
+    entry = lookup_upload_entry(name) or get_unindexed_upload(name)
+    if not entry:
+        raise HTTPException(status_code=404, detail="File not found")
+    etag = f'"{entry["hash"] or "%x-%x" % (entry["size"], entry["mtime_ns"])}"'
+    stem = os.path.splitext(os.path.basename(entry["name"]))[0]
+    cache_control = UPLOAD_CACHE_CONTROL if CONTENT_HASH_PATTERN.fullmatch(stem) else UPLOAD_MUTABLE_CACHE_CONTROL
+    headers = {"Cache-Control": cache_control, "ETag": etag}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    if UPLOAD_SENDFILE_HEADER:
+        return build_sendfile_response(entry, headers)
+    return FileResponse(entry["path"], media_type=entry["mime"], headers=headers)
+
+
+@app.on_event("startup")
+async def start_upload_manifest_refresh() -> None:
+    asyncio.create_task(upload_manifest_loop())
+
+
+MEDIA_URL_FIELDS = {
+    "image": "imageUrls",
+    "video": "videoUrls",
+    "audio": "audioUrls",
+    "document": "documentUrls",
+}
+
+
+def collect_media_urls(flow: Flow, source_id: str, kind: str) -> List[str]:
+    field = MEDIA_URL_FIELDS.get(kind)
     if not field:
         return []
-    nodes_by_id = {node.get("id"): node for node in flow.nodes}
+    compiled = get_compiled_flow(flow)
     urls: List[str] = []
-    for edge in flow.edges:
-        if edge.get("source") != source_id:
-            continue
-        target_node = nodes_by_id.get(edge.get("target"))
+    for edge in compiled.edges_by_source.get(source_id, []):
+        target_node = compiled.nodes_by_id.get(edge.get("target"))
         if not target_node:
             continue
         target_data = target_node.get("data", {})
@@ -2046,161 +2898,359 @@ def collect_document_urls(flow: Flow, source_id: str) -> List[str]:
     return collect_media_urls(flow, source_id, "document")
 
 
-def resolve_upload_source(url: str):
+def hash_file(path: str) -> Optional[str]:
+    digest = hashlib.sha256()
+    try:
+        with open(path, "rb") as file_obj:
+            for chunk in iter(lambda: file_obj.read(UPLOAD_CHUNK_SIZE), b""):
+                digest.update(chunk)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+def build_upload_entry(name: str, path: str, stat: os.stat_result, content_hash: Optional[str] = None) -> Optional[dict]:
+    if content_hash is None:
+        stem = os.path.splitext(os.path.basename(name))[0]
+        content_hash = stem if CONTENT_HASH_PATTERN.fullmatch(stem) else hash_file(path)
+    if not content_hash:
+        return None
+    source = FSInputFile(path)
+    source.content_hash = content_hash
+    return {
+        "name": name,
+        "path": path,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "hash": content_hash,
+        "mime": mimetypes.guess_type(name)[0] or "application/octet-stream",
+        "source": source,
+    }
+
+
+def load_upload_hashes() -> Dict[str, sqlite3.Row]:
+    with get_connection() as conn:
+        rows = conn.execute("SELECT * FROM upload_hashes").fetchall()
+    return {row["name"]: row for row in rows}
+
+
+def save_upload_hashes(entries: List[dict]) -> None:
+    if not entries:
+        return
+    with get_connection() as conn:
+        conn.executemany(
+            """
+            INSERT INTO upload_hashes (name, size, mtime_ns, content_hash)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET
+                size = excluded.size,
+                mtime_ns = excluded.mtime_ns,
+                content_hash = excluded.content_hash
+            """,
+            [(entry["name"], entry["size"], entry["mtime_ns"], entry["hash"]) for entry in entries],
+        )
+        conn.commit()
+
+
+def scan_upload_dir(previous: Dict[str, dict]) -> Dict[str, dict]:
+    manifest: Dict[str, dict] = {}
+    known: Optional[Dict[str, sqlite3.Row]] = None
+    hashed: List[dict] = []
+    root = os.path.abspath(UPLOAD_DIR)
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [dirname for dirname in dirnames if not dirname.startswith(".")]
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            name = os.path.relpath(path, root).replace(os.sep, "/")
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entry = previous.get(name)
+            if not entry or entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+                if known is None:
+                    known = load_upload_hashes()
+                row = known.get(name)
+                if row and row["size"] == stat.st_size and row["mtime_ns"] == stat.st_mtime_ns:
+                    entry = build_upload_entry(name, path, stat, row["content_hash"])
+                else:
+                    entry = build_upload_entry(name, path, stat)
+                    if entry:
+                        hashed.append(entry)
+            if entry:
+                manifest[name] = entry
+    save_upload_hashes(hashed)
+    return manifest
+
+
+def apply_upload_manifest(manifest: Dict[str, dict]) -> None:
+    with UPLOAD_MANIFEST_LOCK:
+        for name in UPLOAD_UNREGISTERED:
+            manifest.pop(name, None)
+        UPLOAD_UNREGISTERED.clear()
+        for name, entry in UPLOAD_MANIFEST.items():
+            if name not in manifest and os.path.exists(entry["path"]):
+                manifest[name] = entry
+        UPLOAD_MANIFEST.clear()
+        UPLOAD_MANIFEST.update(manifest)
+        UPLOAD_HASH_INDEX.clear()
+        for name in sorted(manifest):
+            UPLOAD_HASH_INDEX.setdefault(manifest[name]["hash"], name)
+
+
+def register_upload(name: str, content_hash: Optional[str] = None) -> None:
+    path = os.path.join(os.path.abspath(UPLOAD_DIR), name)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return
+    entry = build_upload_entry(name, path, stat, content_hash)
+    if not entry:
+        return
+    if content_hash is None:
+        save_upload_hashes([entry])
+    with UPLOAD_MANIFEST_LOCK:
+        UPLOAD_MANIFEST[name] = entry
+        UPLOAD_HASH_INDEX.setdefault(entry["hash"], name)
+        UPLOAD_UNREGISTERED.discard(name)
+
+
+def unregister_upload(name: str) -> None:
+    with UPLOAD_MANIFEST_LOCK:
+        entry = UPLOAD_MANIFEST.pop(name, None)
+        UPLOAD_UNREGISTERED.add(name)
+        if entry and UPLOAD_HASH_INDEX.get(entry["hash"]) == name:
+            UPLOAD_HASH_INDEX.pop(entry["hash"], None)
+    if not entry:
+        return
+    with get_connection() as conn:
+        conn.execute("DELETE FROM upload_hashes WHERE name = ?", (name,))
+        conn.commit()
+
+
+async def refresh_upload_manifest() -> None:
+    with UPLOAD_MANIFEST_LOCK:
+        previous = dict(UPLOAD_MANIFEST)
+        UPLOAD_UNREGISTERED.clear()
+    manifest = await asyncio.to_thread(scan_upload_dir, previous)
+    apply_upload_manifest(manifest)
+
+
+async def upload_manifest_loop() -> None:
+    while True:
+        try:
+            await refresh_upload_manifest()
+        except Exception as exc:
+            print(f"upload manifest rescan failed: {exc}")
+        if UPLOAD_RESCAN_SECONDS <= 0:
+            return
+        await asyncio.sleep(UPLOAD_RESCAN_SECONDS)
+
+
+def normalize_upload_name(relative: str) -> str:
+    parts = [part for part in relative.replace("\\", "/").split("/") if part and part != "."]
+    if not parts or ".." in parts:
+        return ""
+    return "/".join(parts)
+
+
+def get_local_upload_hosts() -> set:
+    hosts = {"localhost", "127.0.0.1"} | UPLOAD_PUBLIC_HOSTS
+    base_host = urlparse(get_webhook_base_url()).hostname
+    if base_host:
+        hosts.add(base_host.lower())
+    return hosts
+
+
+def parse_upload_name(url: str) -> str:
+    if url.startswith("/uploads/"):
+        return normalize_upload_name(url[len("/uploads/"):])
+    if url.startswith("http://") or url.startswith("https://"):
+        parsed = urlparse(url)
+        if parsed.hostname not in get_local_upload_hosts():
+            return ""
+        if parsed.path.startswith("/uploads/"):
+            return normalize_upload_name(parsed.path[len("/uploads/"):])
+        return normalize_upload_name(os.path.basename(parsed.path))
+    return normalize_upload_name(url)
+
+
+def get_upload_name(url: str) -> str:
+    name = UPLOAD_NAME_CACHE.get(url)
+    if name is None:
+        name = parse_upload_name(url)
+        UPLOAD_NAME_CACHE.set(url, name)
+    return name
+
+
+def resolve_upload_source(url: str, uploads: Optional[Dict[str, Optional[dict]]] = None):
     if not isinstance(url, str):
         return None
     cleaned = url.strip()
     if not cleaned:
         return None
-    if cleaned.startswith("/uploads/"):
-        filename = os.path.basename(cleaned)
-        path = os.path.join(UPLOAD_DIR, filename)
-        if os.path.exists(path):
-            return FSInputFile(path)
-        return cleaned
-    if cleaned.startswith("http://") or cleaned.startswith("https://"):
-        parsed = urlparse(cleaned)
-        if parsed.hostname in ("localhost", "127.0.0.1"):
-            filename = os.path.basename(parsed.path)
-            path = os.path.join(UPLOAD_DIR, filename)
-            if os.path.exists(path):
-                return FSInputFile(path)
-        return cleaned
-    path = os.path.join(UPLOAD_DIR, os.path.basename(cleaned))
-    if os.path.exists(path):
-        return FSInputFile(path)
+    name = get_upload_name(cleaned)
+    entry = lookup_upload_entry(name) if name else None
+    if uploads is not None and name:
+        uploads[name] = entry
+    if entry:
+        return entry["source"]
+    unindexed = get_unindexed_upload(name) if name else None
+    if unindexed:
+        return unindexed["source"]
     return cleaned
 
 
-async def send_images(
-    message: Message,
-    urls: List[str],
-    caption: str = "",
-    reply_markup=None,
-    target_chat_id: Optional[int] = None,
-) -> bool:
-    sources = [resolve_upload_source(url) for url in urls]
-    sources = [source for source in sources if source]
-    if not sources:
-        return False
-    chat_id = target_chat_id if target_chat_id is not None else message.chat.id
-    use_bot = target_chat_id is not None and message.chat and target_chat_id != message.chat.id
-    if len(sources) == 1:
-        if use_bot:
-            await message.bot.send_photo(chat_id, sources[0], caption=caption or None, reply_markup=reply_markup)
-        else:
-            await message.answer_photo(sources[0], caption=caption or None, reply_markup=reply_markup)
-        return True
-    media = []
-    for idx, source in enumerate(sources):
-        if idx == 0 and caption:
-            media.append(InputMediaPhoto(media=source, caption=caption))
-        else:
-            media.append(InputMediaPhoto(media=source))
-    if use_bot:
-        await message.bot.send_media_group(chat_id, media)
-    else:
-        await message.answer_media_group(media)
-    return True
+def get_file_id_cache_key(telegram_bot: TelegramBot, kind: str, source) -> Optional[Tuple[int, str, str]]:
+    if not isinstance(source, FSInputFile):
+        return None
+    telegram_bot_id = getattr(telegram_bot, "id", None)
+    if telegram_bot_id is None:
+        return None
+    content_hash = getattr(source, "content_hash", None)
+    if not content_hash:
+        return None
+    return (telegram_bot_id, content_hash, kind)
 
 
-async def send_videos(
-    message: Message,
-    urls: List[str],
-    caption: str = "",
-    reply_markup=None,
-    target_chat_id: Optional[int] = None,
-) -> bool:
-    sources = [resolve_upload_source(url) for url in urls]
-    sources = [source for source in sources if source]
-    if not sources:
-        return False
-    chat_id = target_chat_id if target_chat_id is not None else message.chat.id
-    use_bot = target_chat_id is not None and message.chat and target_chat_id != message.chat.id
-    if len(sources) == 1:
-        if use_bot:
-            await message.bot.send_video(chat_id, sources[0], caption=caption or None, reply_markup=reply_markup)
-        else:
-            await message.answer_video(sources[0], caption=caption or None, reply_markup=reply_markup)
-        return True
-    media = []
-    for idx, source in enumerate(sources):
-        if idx == 0 and caption:
-            media.append(InputMediaVideo(media=source, caption=caption))
-        else:
-            media.append(InputMediaVideo(media=source))
-    if use_bot:
-        await message.bot.send_media_group(chat_id, media)
-    else:
-        await message.answer_media_group(media)
-    return True
+def warm_file_id_cache(telegram_bot_id: int) -> None:
+    with get_connection() as conn:
+        rows = conn.execute(
+            """
+            SELECT content_hash, media_kind, file_id FROM media_file_ids
+            WHERE telegram_bot_id = ?
+            ORDER BY updated_at DESC
+            LIMIT ?
+            """,
+            (telegram_bot_id, FILE_ID_CACHE.max_size),
+        ).fetchall()
+    for row in reversed(rows):
+        FILE_ID_CACHE.set((telegram_bot_id, row["content_hash"], row["media_kind"]), row["file_id"])
+    if len(rows) < FILE_ID_CACHE.max_size:
+        FILE_ID_WARMED.add(telegram_bot_id)
 
 
-async def send_audios(
-    message: Message,
-    urls: List[str],
-    caption: str = "",
-    reply_markup=None,
-    target_chat_id: Optional[int] = None,
-) -> bool:
-    sources = [resolve_upload_source(url) for url in urls]
-    sources = [source for source in sources if source]
-    if not sources:
-        return False
-    chat_id = target_chat_id if target_chat_id is not None else message.chat.id
-    use_bot = target_chat_id is not None and message.chat and target_chat_id != message.chat.id
-    if len(sources) == 1:
-        if use_bot:
-            await message.bot.send_audio(chat_id, sources[0], caption=caption or None, reply_markup=reply_markup)
-        else:
-            await message.answer_audio(sources[0], caption=caption or None, reply_markup=reply_markup)
-        return True
-    media = []
-    for idx, source in enumerate(sources):
-        if idx == 0 and caption:
-            media.append(InputMediaAudio(media=source, caption=caption))
-        else:
-            media.append(InputMediaAudio(media=source))
-    if use_bot:
-        await message.bot.send_media_group(chat_id, media)
-    else:
-        await message.answer_media_group(media)
-    return True
+def get_cached_file_id(key: Tuple[int, str, str]) -> Optional[str]:
+    file_id = FILE_ID_CACHE.get(key)
+    if file_id is None and key[0] in FILE_ID_WARMED and len(FILE_ID_CACHE) < FILE_ID_CACHE.max_size:
+        return None
+    if file_id is None:
+        with get_connection() as conn:
+            row = conn.execute(
+                """
+                SELECT file_id FROM media_file_ids
+                WHERE telegram_bot_id = ? AND content_hash = ? AND media_kind = ?
+                """,
+                key,
+            ).fetchone()
+        file_id = row["file_id"] if row else ""
+        FILE_ID_CACHE.set(key, file_id)
+    return file_id or None
 
 
-async def send_documents(
-    message: Message,
-    urls: List[str],
-    caption: str = "",
-    reply_markup=None,
-    target_chat_id: Optional[int] = None,
-) -> bool:
-    sources = [resolve_upload_source(url) for url in urls]
-    sources = [source for source in sources if source]
-    if not sources:
-        return False
-    chat_id = target_chat_id if target_chat_id is not None else message.chat.id
-    use_bot = target_chat_id is not None and message.chat and target_chat_id != message.chat.id
-    if len(sources) == 1:
-        if use_bot:
-            await message.bot.send_document(chat_id, sources[0], caption=caption or None, reply_markup=reply_markup)
-        else:
-            await message.answer_document(sources[0], caption=caption or None, reply_markup=reply_markup)
-        return True
-    media = []
-    for idx, source in enumerate(sources):
-        if idx == 0 and caption:
-            media.append(InputMediaDocument(media=source, caption=caption))
-        else:
-            media.append(InputMediaDocument(media=source))
-    if use_bot:
-        await message.bot.send_media_group(chat_id, media)
+def remember_file_id(key: Tuple[int, str, str], file_id: str) -> None:
+    FILE_ID_CACHE.set(key, file_id)
+    with get_connection() as conn:
+        conn.execute(
+            """
+            INSERT INTO media_file_ids (telegram_bot_id, content_hash, media_kind, file_id, updated_at)
+            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(telegram_bot_id, content_hash, media_kind) DO UPDATE SET
+                file_id = excluded.file_id,
+                updated_at = CURRENT_TIMESTAMP
+            """,
+            (*key, file_id),
+        )
+        conn.commit()
+
+
+def forget_file_id(key: Tuple[int, str, str]) -> None:
+    FILE_ID_CACHE.set(key, "")
+    with get_connection() as conn:
+        conn.execute(
+            "DELETE FROM media_file_ids WHERE telegram_bot_id = ? AND content_hash = ? AND media_kind = ?",
+            key,
+        )
+        conn.commit()
+
+
+def is_stale_file_id_error(exc: Exception) -> bool:
+    text = str(exc).lower()
+    return "file identifier" in text or "file reference" in text or "file_id" in text
+
+
+MEDIA_RESPONSE_FIELDS = {
+    "video": ("video", "animation", "document"),
+    "audio": ("audio", "voice", "document"),
+    "document": ("document", "animation", "video", "audio"),
+}
+
+
+def extract_sent_file_id(sent_message, kind: str) -> Optional[str]:
+    if sent_message is None:
+        return None
+    if kind == "image":
+        photos = getattr(sent_message, "photo", None)
+        return photos[-1].file_id if photos else None
+    for field in MEDIA_RESPONSE_FIELDS.get(kind, ()):
+        media = getattr(sent_message, field, None)
+        if media is not None and getattr(media, "file_id", None):
+            return media.file_id
+    return None
+
+
+def resolve_upload_sources(urls: List[str], uploads: Optional[Dict[str, Optional[dict]]] = None) -> list:
+    sources = [resolve_upload_source(url, uploads) for url in urls]
+    return [source for source in sources if source]
+
+
+def build_send_plan(flow: Flow, node: dict) -> dict:
+    payload = node.get("data", {})
+    kind = payload.get("kind")
+    node_id = node.get("id") or ""
+    uploads: Dict[str, Optional[dict]] = {}
+    if kind in MEDIA_URL_FIELDS:
+        text = ""
+        sources = resolve_upload_sources(payload.get(MEDIA_URL_FIELDS[kind]) or [], uploads)
+        media = [(kind, sources)] if sources else []
     else:
-        await message.answer_media_group(media)
-    return True
+        raw_text = payload.get("editMessageText") if kind == "edit_message" else payload.get("messageText")
+        text = (raw_text or "").strip()
+        media = []
+        for media_kind in MEDIA_URL_FIELDS:
+            sources = resolve_upload_sources(collect_media_urls(flow, node_id, media_kind), uploads)
+            if sources:
+                media.append((media_kind, sources))
+    return {
+        "kind": kind,
+        "uploads": uploads,
+        "text": text,
+        "parse_mode": detect_parse_mode(text),
+        "media": media,
+        "reply_markup": build_reply_markup(flow, node_id),
+    }
 
 
-async def send_content_node(
+def get_send_plan(flow: Flow, node: dict) -> dict:
+    compiled = get_compiled_flow(flow)
+    node_id = node.get("id") or ""
+    plan = compiled.send_plans.get(node_id)
+    if plan is None or any(UPLOAD_MANIFEST.get(name) is not entry for name, entry in plan["uploads"].items()):
+        plan = build_send_plan(flow, node)
+        compiled.send_plans[node_id] = plan
+    return plan
+
+
+def build_answer_kwargs(message: Message) -> dict:
+    kwargs = {}
+    if getattr(message, "is_topic_message", None):
+        kwargs["message_thread_id"] = message.message_thread_id
+    if getattr(message, "business_connection_id", None):
+        kwargs["business_connection_id"] = message.business_connection_id
+    return kwargs
+
+
+async def send_content_node(
     flow: Flow,
     message: Message,
     target_node: dict,
@@ -2209,173 +3259,20 @@ async def send_content_node(
     row_data: Optional[dict] = None,
     extra_vars: Optional[dict] = None,
 ) -> None:
-    payload = target_node.get("data", {})
-    kind = payload.get("kind")
-    if kind == "delete_message":
+    kind = target_node.get("data", {}).get("kind")
+    if kind in ("delete_message", "edit_message"):
         try:
             await message.delete()
         except Exception:
             pass
-        return
-    is_edit = kind == "edit_message"
-    if kind == "message" or is_edit:
-        if is_edit:
-            try:
-                await message.delete()
-            except Exception:
-                pass
-        raw_text = payload.get("editMessageText") if is_edit else payload.get("messageText")
-        message_text = render_template((raw_text or "").strip(), message, source_user, row_data=row_data, extra_vars=extra_vars)
-        image_urls = collect_image_urls(flow, target_node.get("id") or "")
-        video_urls = collect_video_urls(flow, target_node.get("id") or "")
-        audio_urls = collect_audio_urls(flow, target_node.get("id") or "")
-        document_urls = collect_document_urls(flow, target_node.get("id") or "")
-        reply_markup = build_reply_markup(flow, target_node.get("id") or "")
-        caption_used = False
-        reply_used = False
-        if image_urls:
-            caption = message_text if message_text and not caption_used else ""
-            await send_images(
-                message,
-                image_urls,
-                caption=caption,
-                reply_markup=reply_markup if not reply_used else None,
-                target_chat_id=target_chat_id,
-            )
-            if caption:
-                caption_used = True
-                reply_used = True
-        if video_urls:
-            caption = message_text if message_text and not caption_used else ""
-            await send_videos(
-                message,
-                video_urls,
-                caption=caption,
-                reply_markup=reply_markup if not reply_used else None,
-                target_chat_id=target_chat_id,
-            )
-            if caption:
-                caption_used = True
-                reply_used = True
-        if audio_urls:
-            caption = message_text if message_text and not caption_used else ""
-            await send_audios(
-                message,
-                audio_urls,
-                caption=caption,
-                reply_markup=reply_markup if not reply_used else None,
-                target_chat_id=target_chat_id,
-            )
-            if caption:
-                caption_used = True
-                reply_used = True
-        if document_urls:
-            caption = message_text if message_text and not caption_used else ""
-            await send_documents(
-                message,
-                document_urls,
-                caption=caption,
-                reply_markup=reply_markup if not reply_used else None,
-                target_chat_id=target_chat_id,
-            )
-            if caption:
-                caption_used = True
-                reply_used = True
-        if not (image_urls or video_urls or audio_urls or document_urls):
-            if message_text:
-                if target_chat_id is not None and message.chat and target_chat_id != message.chat.id:
-                    await message.bot.send_message(target_chat_id, message_text, reply_markup=reply_markup)
-                else:
-                    await message.answer(message_text, reply_markup=reply_markup)
-        return
-    if kind == "image":
-        urls = payload.get("imageUrls") or []
-        reply_markup = build_reply_markup(flow, target_node.get("id") or "")
-        await send_images(message, urls, reply_markup=reply_markup, target_chat_id=target_chat_id)
-        return
-    if kind == "video":
-        urls = payload.get("videoUrls") or []
-        reply_markup = build_reply_markup(flow, target_node.get("id") or "")
-        await send_videos(message, urls, reply_markup=reply_markup, target_chat_id=target_chat_id)
-        return
-    if kind == "audio":
-        urls = payload.get("audioUrls") or []
-        reply_markup = build_reply_markup(flow, target_node.get("id") or "")
-        await send_audios(message, urls, reply_markup=reply_markup, target_chat_id=target_chat_id)
-        return
-    if kind == "document":
-        urls = payload.get("documentUrls") or []
-        reply_markup = build_reply_markup(flow, target_node.get("id") or "")
-        await send_documents(message, urls, reply_markup=reply_markup, target_chat_id=target_chat_id)
-        return
-    message_text = render_template(
-        (payload.get("messageText") or "").strip(),
-        message,
-        source_user,
-        row_data=row_data,
-        extra_vars=extra_vars,
-    )
-    image_urls = collect_image_urls(flow, target_node.get("id") or "")
-    video_urls = collect_video_urls(flow, target_node.get("id") or "")
-    audio_urls = collect_audio_urls(flow, target_node.get("id") or "")
-    document_urls = collect_document_urls(flow, target_node.get("id") or "")
-    reply_markup = build_reply_markup(flow, target_node.get("id") or "")
-    caption_used = False
-    reply_used = False
-    if image_urls:
-        caption = message_text if message_text and not caption_used else ""
-        await send_images(
-            message,
-            image_urls,
-            caption=caption,
-            reply_markup=reply_markup if not reply_used else None,
-            target_chat_id=target_chat_id,
-        )
-        if caption:
-            caption_used = True
-            reply_used = True
-    if video_urls:
-        caption = message_text if message_text and not caption_used else ""
-        await send_videos(
-            message,
-            video_urls,
-            caption=caption,
-            reply_markup=reply_markup if not reply_used else None,
-            target_chat_id=target_chat_id,
-        )
-        if caption:
-            caption_used = True
-            reply_used = True
-    if audio_urls:
-        caption = message_text if message_text and not caption_used else ""
-        await send_audios(
-            message,
-            audio_urls,
-            caption=caption,
-            reply_markup=reply_markup if not reply_used else None,
-            target_chat_id=target_chat_id,
-        )
-        if caption:
-            caption_used = True
-            reply_used = True
-    if document_urls:
-        caption = message_text if message_text and not caption_used else ""
-        await send_documents(
-            message,
-            document_urls,
-            caption=caption,
-            reply_markup=reply_markup if not reply_used else None,
-            target_chat_id=target_chat_id,
-        )
-        if caption:
-            caption_used = True
-            reply_used = True
-    if not (image_urls or video_urls or audio_urls or document_urls):
-        if message_text:
-            if target_chat_id is not None and message.chat and target_chat_id != message.chat.id:
-                await message.bot.send_message(target_chat_id, message_text, reply_markup=reply_markup)
-            else:
-                await message.answer(message_text, reply_markup=reply_markup)
+        if kind == "delete_message":
+            return
+    plan = get_send_plan(flow, target_node)
+    message_text = render_template(plan["text"], message, source_user, row_data=row_data, extra_vars=extra_vars)
+    if target_chat_id is not None and message.chat and target_chat_id != message.chat.id:
+        await send_planned_content(message.bot, target_chat_id, plan, message_text)
+    else:
+        await send_planned_content(message.bot, message.chat.id, plan, message_text, **build_answer_kwargs(message))
 
 
 async def send_targets_with_delay(
@@ -2383,12 +3280,64 @@ async def send_targets_with_delay(
     message: Message,
     targets: List[Tuple[dict, float, Optional[int], Optional[dict], Optional[dict]]],
     source_user: Optional[object] = None,
+    bot_id: Optional[str] = None,
 ) -> None:
     if not targets:
         return
     ordered = sorted(targets, key=lambda item: item[1])
+    key = (bot_id, message.chat.id if message.chat else None)
+    previous = DELAYED_SEND_TAILS.get(key)
+    if previous is None or previous.done():
+        immediate = [target for target in ordered if target[1] <= 0]
+        await send_ordered_targets(flow, message, immediate, source_user, bot_id)
+        previous = None
+        ordered = [target for target in ordered if target[1] > 0]
+    if not ordered:
+        return
+    task = asyncio.create_task(send_targets_after(previous, flow, message, ordered, source_user, bot_id))
+    DELAYED_SEND_TAILS[key] = task
+    task.add_done_callback(lambda done: release_delayed_send_tail(key, done))
+    if bot_id:
+        tasks = DELAYED_SEND_TASKS.setdefault(bot_id, set())
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+
+async def send_targets_after(
+    previous: Optional[asyncio.Task],
+    flow: Flow,
+    message: Message,
+    targets: List[Tuple[dict, float, Optional[int], Optional[dict], Optional[dict]]],
+    source_user: Optional[object] = None,
+    bot_id: Optional[str] = None,
+) -> None:
+    if previous is not None:
+        started = time.monotonic()
+        await asyncio.wait([previous])
+        waited = time.monotonic() - started
+        targets = [(node, max(0.0, delay - waited), *rest) for node, delay, *rest in targets]
+    await send_ordered_targets(flow, message, targets, source_user, bot_id)
+
+
+def release_delayed_send_tail(key: Tuple[Optional[str], object], task: asyncio.Task) -> None:
+    if DELAYED_SEND_TAILS.get(key) is task:
+        DELAYED_SEND_TAILS.pop(key, None)
+
+
+def cancel_delayed_sends(bot_id: str) -> None:
+    for task in list(DELAYED_SEND_TASKS.pop(bot_id, None) or ()):
+        task.cancel()
+
+
+async def send_ordered_targets(
+    flow: Flow,
+    message: Message,
+    targets: List[Tuple[dict, float, Optional[int], Optional[dict], Optional[dict]]],
+    source_user: Optional[object] = None,
+    bot_id: Optional[str] = None,
+) -> None:
     elapsed = 0.0
-    for target_node, delay, target_chat_id, row_data, extra_vars in ordered:
+    for target_node, delay, target_chat_id, row_data, extra_vars in targets:
         wait_time = delay - elapsed
         if wait_time > 0:
             await asyncio.sleep(wait_time)
@@ -2396,26 +3345,461 @@ async def send_targets_with_delay(
         try:
             await send_content_node(flow, message, target_node, target_chat_id, source_user, row_data, extra_vars)
         except Exception as exc:
-            print(f"send_content_node failed for chat {target_chat_id}: {exc}")
+            chat_id = target_chat_id if target_chat_id is not None else (message.chat.id if message.chat else None)
+            handle_send_failure(bot_id, chat_id, target_node.get("id"), "interactive", exc)
+
+
+def get_rate_limiter(telegram_bot_id: int) -> dict:
+    limiter = RATE_LIMITERS.get(telegram_bot_id)
+    if limiter is None:
+        bucket = TokenBucket(RATE_GLOBAL_PER_SECOND, RATE_GLOBAL_PER_SECOND)
+        limiter = {
+            "global": bucket,
+            "queue": OutboundQueue(bucket),
+            "chats": {},
+        }
+        RATE_LIMITERS[telegram_bot_id] = limiter
+    return limiter
+
+
+def get_chat_bucket(limiter: dict, chat_id) -> TokenBucket:
+    chats: Dict[object, TokenBucket] = limiter["chats"]
+    bucket = chats.get(chat_id)
+    if bucket is not None:
+        return bucket
+    if len(chats) >= RATE_PRUNE_THRESHOLD:
+        now = time.monotonic()
+        for key in [key for key, item in chats.items() if item.is_idle(now)]:
+            chats.pop(key, None)
+    if isinstance(chat_id, int) and chat_id > 0:
+        bucket = TokenBucket(RATE_PRIVATE_PER_SECOND, RATE_PRIVATE_BURST)
+    else:
+        bucket = TokenBucket(RATE_GROUP_PER_MINUTE / 60.0, RATE_GROUP_BURST)
+    chats[chat_id] = bucket
+    return bucket
+
+
+def is_rate_limited_method(method) -> bool:
+    if isinstance(method, SendChatAction):
+        return False
+    name = type(method).__name__
+    return name.startswith("Send") or name.startswith("Copy") or name.startswith("Forward")
+
+
+async def acquire_send_slot(limiter: dict, chat_bucket: Optional[TokenBucket], cost: float) -> None:
+    if chat_bucket is not None:
+        wait = chat_bucket.reserve(cost)
+        if wait > 0:
+            await asyncio.sleep(wait)
+    await limiter["queue"].acquire(SEND_PRIORITY.get(), cost)
+
+
+def classify_send_error(exc: Exception) -> str:
+    if isinstance(exc, TelegramEntityTooLarge):
+        return "permanent"
+    if isinstance(exc, (TelegramRetryAfter, TelegramNetworkError, TelegramServerError, asyncio.TimeoutError)):
+        return "retryable"
+    return "permanent"
+
+
+BLOCKED_ERROR_MARKERS = ("bot was blocked by the user", "user is deactivated")
+
+
+def is_blocked_error(exc: Exception) -> bool:
+    message = str(exc).lower()
+    return any(marker in message for marker in BLOCKED_ERROR_MARKERS)
+
+
+def is_unsent_network_error(exc: Exception) -> bool:
+    return isinstance(exc.__context__, ClientConnectorError)
+
+
+def get_backoff_delay(attempt: int) -> float:
+    return random.uniform(0, min(SEND_BACKOFF_MAX, SEND_BACKOFF_BASE * (2 ** attempt)))
+
+
+def mark_user_blocked(bot_id: str, user_id: int) -> None:
+    with get_connection() as conn:
+        conn.execute(
+            "UPDATE user_status SET blocked = 1 WHERE bot_id = ? AND user_id = ?",
+            (bot_id, user_id),
+        )
+        conn.commit()
+
+
+def record_dead_letter(
+    bot_id: Optional[str],
+    chat_id: Optional[int],
+    node_id: Optional[str],
+    source: str,
+    exc: Exception,
+) -> None:
+    if not bot_id:
+        return
+    try:
+        with get_connection() as conn:
+            conn.execute(
+                """
+                INSERT INTO dead_letters (bot_id, chat_id, node_id, source, error_kind, error)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (bot_id, chat_id, node_id, source, classify_send_error(exc), str(exc)),
+            )
+            conn.commit()
+    except Exception as db_exc:
+        print(f"dead letter write failed: {db_exc}")
+        return
+    DEAD_LETTER_STATE["inserts"] += 1
+    if DEAD_LETTER_STATE["inserts"] % DEAD_LETTER_PRUNE_EVERY == 0:
+        prune_dead_letters(bot_id)
+
+
+def prune_dead_letters(bot_id: str) -> None:
+    try:
+        with get_connection() as conn:
+            conn.execute(
+                "DELETE FROM dead_letters WHERE created_at < datetime('now', ?)",
+                (f"-{DEAD_LETTER_RETENTION_DAYS} days",),
+            )
+            conn.execute(
+                """
+                DELETE FROM dead_letters WHERE bot_id = ? AND id <= (
+                    SELECT id FROM dead_letters WHERE bot_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?
+                )
+                """,
+                (bot_id, bot_id, DEAD_LETTER_MAX_ROWS),
+            )
+            conn.commit()
+    except Exception as exc:
+        print(f"dead letter prune failed: {exc}")
+
+
+def handle_send_failure(
+    bot_id: Optional[str],
+    chat_id: Optional[int],
+    node_id: Optional[str],
+    source: str,
+    exc: Exception,
+) -> None:
+    print(f"{source} send failed for chat {chat_id}: {exc}")
+    if bot_id and isinstance(chat_id, int) and chat_id > 0 and is_blocked_error(exc):
+        mark_user_blocked(bot_id, chat_id)
+    record_dead_letter(bot_id, chat_id, node_id, source, exc)
+
+
+async def rate_limit_middleware(make_request, bot: TelegramBot, method):
+    if not is_rate_limited_method(method):
+        return await make_request(bot, method)
+    limiter = get_rate_limiter(bot.id)
+    chat_id = getattr(method, "chat_id", None)
+    chat_bucket = get_chat_bucket(limiter, chat_id) if chat_id is not None else None
+    cost = float(len(method.media)) if isinstance(method, SendMediaGroup) else 1.0
+    flood_attempts = 0
+    error_attempts = 0
+    while True:
+        await acquire_send_slot(limiter, chat_bucket, cost)
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter as exc:
+            flood_attempts += 1
+            (chat_bucket or limiter["global"]).block(exc.retry_after)
+            if flood_attempts > RATE_RETRY_LIMIT:
+                raise
+            print(f"rate limited for chat {chat_id}, retrying in {exc.retry_after}s")
+        except (TelegramNetworkError, TelegramServerError) as exc:
+            error_attempts += 1
+            if classify_send_error(exc) != "retryable" or error_attempts > SEND_RETRY_LIMIT:
+                raise
+            if isinstance(exc, TelegramNetworkError) and not is_unsent_network_error(exc):
+                raise
+            delay = get_backoff_delay(error_attempts)
+            print(f"send to chat {chat_id} failed ({exc}), retrying in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+
+class PooledAiohttpSession(AiohttpSession):
+    def __init__(self, limit: int, **kwargs) -> None:
+        super().__init__(limit=limit, **kwargs)
+        self.connector_options = {
+            "ssl": ssl.create_default_context(cafile=certifi.where()),
+            "limit": limit,
+            "ttl_dns_cache": HTTP_DNS_TTL_SECONDS,
+            "keepalive_timeout": HTTP_KEEPALIVE_SECONDS,
+        }
+        self.client_session: Optional[ClientSession] = None
+
+    async def create_session(self) -> ClientSession:
+        if self.client_session is None or self.client_session.closed:
+            self.client_session = ClientSession(connector=TCPConnector(**self.connector_options))
+        return self.client_session
+
+    async def close(self) -> None:
+        if self.client_session is not None and not self.client_session.closed:
+            await self.client_session.close()
+            await asyncio.sleep(0.25)
+
+
+def get_http_session() -> AiohttpSession:
+    session = HTTP_CLIENT_STATE["session"]
+    if session is None:
+        session = PooledAiohttpSession(limit=HTTP_POOL_LIMIT, timeout=HTTP_TIMEOUT_SECONDS)
+        session.middleware(rate_limit_middleware)
+        HTTP_CLIENT_STATE["session"] = session
+    return session
+
+
+def get_telegram_bot(token: str) -> TelegramBot:
+    telegram_bot = TELEGRAM_CLIENTS.get(token)
+    if telegram_bot is None:
+        telegram_bot = TelegramBot(token, session=get_http_session())
+        TELEGRAM_CLIENTS.set(token, telegram_bot)
+    return telegram_bot
+
+
+def release_telegram_bot(token: Optional[str]) -> None:
+    if token:
+        TELEGRAM_CLIENTS.pop(token, None)
+
+
+def get_polling_session() -> AiohttpSession:
+    session = HTTP_CLIENT_STATE["polling"]
+    if session is None:
+        session = PooledAiohttpSession(limit=0, timeout=HTTP_TIMEOUT_SECONDS)
+        HTTP_CLIENT_STATE["polling"] = session
+    return session
+
+
+@app.on_event("shutdown")
+async def close_http_session() -> None:
+    sessions = [HTTP_CLIENT_STATE["session"], HTTP_CLIENT_STATE["polling"]]
+    HTTP_CLIENT_STATE["session"] = None
+    HTTP_CLIENT_STATE["polling"] = None
+    TELEGRAM_CLIENTS.clear()
+    for session in sessions:
+        if session is not None:
+            await session.close()
+
+
+def collect_flow_media(flow: Flow) -> List[Tuple[str, object]]:
+    media: List[Tuple[str, object]] = []
+    for node in flow.nodes:
+        data = node.get("data", {})
+        kind = data.get("kind")
+        field = MEDIA_URL_FIELDS.get(kind)
+        if not field:
+            continue
+        for source in resolve_upload_sources(data.get(field) or []):
+            media.append((kind, source))
+    return media
+
+
+def get_prewarm_chat_id():
+    try:
+        return int(PREWARM_CHAT_ID)
+    except ValueError:
+        return PREWARM_CHAT_ID
+
+
+async def prewarm_flow_media(bot: Bot, flow: Flow) -> None:
+    SEND_PRIORITY.set("broadcast")
+    progress = {"status": "running", "total": 0, "uploaded": 0, "cached": 0, "failed": 0}
+    PREWARM_PROGRESS[bot.id] = progress
+    telegram_bot = get_telegram_bot(bot.token)
+    chat_id = get_prewarm_chat_id()
+    semaphore = asyncio.Semaphore(PREWARM_CONCURRENCY)
+
+    async def upload(key: Tuple[int, str, str], kind: str, source) -> None:
+        async with semaphore:
+            if get_cached_file_id(key):
+                progress["cached"] += 1
+                return
+            try:
+                sent = await send_media_via_bot(telegram_bot, chat_id, kind, [source], disable_notification=True)
+                progress["uploaded"] += 1
+            except Exception as exc:
+                progress["failed"] += 1
+                print(f"media prewarm failed for {source.path}: {exc}")
+                return
+            for message in sent:
+                try:
+                    await telegram_bot.delete_message(chat_id, message.message_id)
+                except Exception as exc:
+                    print(f"media prewarm cleanup failed for {source.path}: {exc}")
+
+    try:
+        pending: Dict[Tuple[int, str, str], Tuple[str, object]] = {}
+        for kind, source in collect_flow_media(flow):
+            key = get_file_id_cache_key(telegram_bot, kind, source)
+            if key and key not in pending:
+                pending[key] = (kind, source)
+        progress["total"] = len(pending)
+        await asyncio.gather(*(upload(key, kind, source) for key, (kind, source) in pending.items()))
+        progress["status"] = "done"
+    except asyncio.CancelledError:
+        progress["status"] = "cancelled"
+        raise
+
+
+def schedule_media_prewarm(bot: Bot, flow: Flow) -> None:
+    if not PREWARM_CHAT_ID or not bot.token:
+        return
+    previous = PREWARM_TASKS.get(bot.id)
+    if previous and not previous.done():
+        previous.cancel()
+    PREWARM_TASKS[bot.id] = asyncio.create_task(prewarm_flow_media(bot, flow))
+
+
+def get_flow_update_types(flow: Flow) -> List[str]:
+    kinds = {node.get("data", {}).get("kind") for node in flow.nodes}
+    update_types = ["message", "channel_post", "my_chat_member"]
+    if kinds & {"message_button", "button_row"}:
+        update_types.append("callback_query")
+    if "subscription" in kinds:
+        update_types.append("chat_member")
+    return update_types
+
+
+def load_polling_offset(bot_id: str) -> Optional[int]:
+    with get_connection() as conn:
+        row = conn.execute("SELECT update_offset FROM bot_polling_state WHERE bot_id = ?", (bot_id,)).fetchone()
+    return row["update_offset"] if row else None
+
+
+def save_polling_offset(bot_id: str, offset: int) -> None:
+    with get_connection() as conn:
+        conn.execute(
+            """
+            INSERT INTO bot_polling_state (bot_id, update_offset, updated_at)
+            VALUES (?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(bot_id) DO UPDATE SET
+                update_offset = excluded.update_offset,
+                updated_at = CURRENT_TIMESTAMP
+            """,
+            (bot_id, offset),
+        )
+        conn.commit()
+
+
+async def process_ingested_update(bot_id: str, update: Update) -> None:
+    entry = RUNNING_BOTS.get(bot_id)
+    if not entry:
+        return
+    dispatcher = entry.get("dispatcher")
+    telegram_bot = entry.get("bot")
+    if not isinstance(dispatcher, Dispatcher) or not isinstance(telegram_bot, TelegramBot):
+        return
+    try:
+        await dispatcher.feed_update(telegram_bot, update)
+    except Exception as exc:
+        print(f"update {update.update_id} failed for bot {bot_id}: {exc}")
+
+
+def get_update_chat_key(bot_id: str, update: Update) -> Tuple[str, object]:
+    event = update.event
+    chat = getattr(event, "chat", None) or getattr(getattr(event, "message", None), "chat", None)
+    if chat is not None:
+        return bot_id, chat.id
+    user = getattr(event, "from_user", None)
+    if user is not None:
+        return bot_id, user.id
+    return bot_id, ("update", update.update_id)
+
+
+async def ingest_pump(queue: asyncio.Queue, executor: KeyedExecutor) -> None:
+    while True:
+        bot_id, update = await queue.get()
+        try:
+            await executor.submit(
+                get_update_chat_key(bot_id, update),
+                lambda bot_id=bot_id, update=update: process_ingested_update(bot_id, update),
+            )
+        finally:
+            queue.task_done()
+
+
+def get_ingest_queue() -> asyncio.Queue:
+    queue = INGEST_STATE["queue"]
+    pump = INGEST_STATE["pump"]
+    if queue is None or pump is None or pump.done():
+        queue = asyncio.Queue(maxsize=INGEST_QUEUE_SIZE)
+        executor = KeyedExecutor(CHAT_CONCURRENCY, INGEST_QUEUE_SIZE)
+        INGEST_STATE["queue"] = queue
+        INGEST_STATE["executor"] = executor
+        INGEST_STATE["pump"] = asyncio.create_task(ingest_pump(queue, executor))
+    return queue
+
+
+def mark_bot_stopped(bot_id: str) -> None:
+    with get_connection() as conn:
+        conn.execute("UPDATE bots SET status = 'stopped' WHERE id = ?", (bot_id,))
+        conn.commit()
+
+
+async def poll_updates(bot: Bot, telegram_bot: TelegramBot) -> None:
+    poller = get_polling_session()
+    offset = load_polling_offset(bot.id)
+    failures = 0
+    webhook_cleared = False
+    while True:
+        flow = FLOW_CACHE.get(bot.id) or bot.flow
+        try:
+            if not webhook_cleared:
+                await telegram_bot.delete_webhook(drop_pending_updates=False)
+                webhook_cleared = True
+            updates = await poller(
+                telegram_bot,
+                GetUpdates(
+                    offset=offset,
+                    limit=POLLING_LIMIT,
+                    timeout=POLLING_TIMEOUT_SECONDS,
+                    allowed_updates=get_flow_update_types(flow),
+                ),
+                timeout=POLLING_TIMEOUT_SECONDS + 15,
+            )
+        except TelegramUnauthorizedError as exc:
+            print(f"polling stopped for bot {bot.id}: {exc}")
+            mark_bot_stopped(bot.id)
+            cancel_broadcast_tasks(bot.id)
+            entry = RUNNING_BOTS.get(bot.id) or {}
+            stop_event = entry.get("stop")
+            if isinstance(stop_event, asyncio.Event):
+                stop_event.set()
+            return
+        except Exception as exc:
+            failures += 1
+            delay = exc.retry_after if isinstance(exc, TelegramRetryAfter) else max(1.0, get_backoff_delay(min(failures, 6)))
+            print(f"polling failed for bot {bot.id}: {exc}")
+            await asyncio.sleep(delay)
+            continue
+        failures = 0
+        for update in updates:
+            await get_ingest_queue().put((bot.id, update))
+            offset = update.update_id + 1
+        if updates:
+            save_polling_offset(bot.id, offset)
+
+
+def resolve_bot_mode(bot: Bot, webhook_base: str) -> str:
+    if bot.mode in ("webhook", "polling"):
+        return bot.mode
+    return "webhook" if webhook_base else "polling"
 
 
 async def run_bot_polling(bot: Bot) -> None:
     if not bot.token:
         return
     dispatcher = Dispatcher()
-    telegram_bot = TelegramBot(bot.token)
+    telegram_bot = get_telegram_bot(bot.token)
     webhook_base = get_webhook_base_url()
-    webhook_url = f"{webhook_base}/webhook/{bot.token}" if webhook_base else ""
+    mode = resolve_bot_mode(bot, webhook_base)
+    webhook_url = f"{webhook_base}/webhook/{bot.token}" if webhook_base and mode == "webhook" else ""
     bot_user = await telegram_bot.get_me()
     bot_user_id = bot_user.id if bot_user else None
-    chat_admin_cache: Dict[int, bool] = {}
     stop_event = asyncio.Event()
-    schedule_last_run: Dict[str, datetime] = {}
-    schedule_executed: set[str] = set()
     async def handler(message: Message) -> None:
         await ensure_user_row(bot.id, message.from_user, telegram_bot)
         if bot_user_id is not None:
-            await ensure_chat_row(bot.id, message.chat, telegram_bot, bot_user_id, chat_admin_cache)
+            await ensure_chat_row(bot.id, message.chat, telegram_bot, bot_user_id)
         command = normalize_command(message.text or "")
         flow = FLOW_CACHE.get(bot.id) or bot.flow
         user_id = message.from_user.id if message.from_user else None
@@ -2425,7 +3809,7 @@ async def run_bot_polling(bot: Bot) -> None:
                 targets = await collect_content_targets_with_delay(
                     flow, command_node.get("id") or "", message, bot.id, user_id
                 )
-                await send_targets_with_delay(flow, message, targets, message.from_user)
+                await send_targets_with_delay(flow, message, targets, message.from_user, bot.id)
                 return
         reply_button = find_reply_button_by_text(flow, message.text or "")
         if reply_button:
@@ -2433,7 +3817,7 @@ async def run_bot_polling(bot: Bot) -> None:
                 flow, reply_button.get("id") or "", message, bot.id, user_id
             )
             if targets:
-                await send_targets_with_delay(flow, message, targets, message.from_user)
+                await send_targets_with_delay(flow, message, targets, message.from_user, bot.id)
                 return
         webhook_nodes = [node for node in flow.nodes if node.get("data", {}).get("kind") == "webhook"]
         if webhook_nodes:
@@ -2444,21 +3828,21 @@ async def run_bot_polling(bot: Bot) -> None:
                         flow, webhook_node.get("id") or "", message, bot.id, user_id
                     )
                 )
-            await send_targets_with_delay(flow, message, all_targets, message.from_user)
+            await send_targets_with_delay(flow, message, all_targets, message.from_user, bot.id)
 
     dispatcher.message()(handler)
 
     async def channel_post_handler(message: Message) -> None:
         if bot_user_id is None:
             return
-        await ensure_chat_row(bot.id, message.chat, telegram_bot, bot_user_id, chat_admin_cache)
+        await ensure_chat_row(bot.id, message.chat, telegram_bot, bot_user_id)
 
     dispatcher.channel_post()(channel_post_handler)
 
     async def callback_handler(query: CallbackQuery) -> None:
         await ensure_user_row(bot.id, query.from_user, telegram_bot)
         if bot_user_id is not None and query.message:
-            await ensure_chat_row(bot.id, query.message.chat, telegram_bot, bot_user_id, chat_admin_cache)
+            await ensure_chat_row(bot.id, query.message.chat, telegram_bot, bot_user_id)
         data = (query.data or "").strip()
         await query.answer()
         if not data:
@@ -2470,7 +3854,7 @@ async def run_bot_polling(bot: Bot) -> None:
         if data.startswith("btn:"):
             button_id = data[4:]
             targets = await collect_content_targets_with_delay(flow, button_id, query.message, bot.id, user_id)
-            await send_targets_with_delay(flow, query.message, targets, query.from_user)
+            await send_targets_with_delay(flow, query.message, targets, query.from_user, bot.id)
             return
         if data.startswith("/"):
             flow = FLOW_CACHE.get(bot.id) or bot.flow
@@ -2481,71 +3865,60 @@ async def run_bot_polling(bot: Bot) -> None:
                     targets = await collect_content_targets_with_delay(
                         flow, command_node.get("id") or "", query.message, bot.id, user_id
                     )
-                    await send_targets_with_delay(flow, query.message, targets, query.from_user)
+                    await send_targets_with_delay(flow, query.message, targets, query.from_user, bot.id)
                 return
         await query.message.answer(data)
 
     dispatcher.callback_query()(callback_handler)
 
-    async def schedule_loop() -> None:
-        while not stop_event.is_set():
-            flow = FLOW_CACHE.get(bot.id) or bot.flow
-            now = datetime.now()
-            for node in flow.nodes:
-                node_id = node.get("id") or ""
-                if not node_id:
-                    continue
-                config = parse_schedule_node(node)
-                if not config:
-                    continue
-                should_run = False
-                if config["type"] == "interval":
-                    last = schedule_last_run.get(node_id)
-                    if last is None or (now - last).total_seconds() >= float(config["seconds"]):
-                        should_run = True
-                elif config["type"] == "daily":
-                    last = schedule_last_run.get(node_id)
-                    daily_time = config["time"]
-                    if now.time() >= daily_time:
-                        if last is None or last.date() != now.date():
-                            should_run = True
-                elif config["type"] == "datetime":
-                    if node_id not in schedule_executed and now >= config["run_at"]:
-                        should_run = True
-                if not should_run:
-                    continue
-                schedule_last_run[node_id] = now
-                if config["type"] == "datetime":
-                    schedule_executed.add(node_id)
-                try:
-                    targets = await collect_scheduled_targets(flow, node_id, bot.id, telegram_bot)
-                    await send_scheduled_targets_with_delay(flow, telegram_bot, targets)
-                except Exception as exc:
-                    print(f"schedule loop error for {node_id}: {exc}")
-            await asyncio.sleep(1)
+    async def chat_member_handler(update: ChatMemberUpdated) -> None:
+        member = update.new_chat_member
+        remember_membership(telegram_bot.id, update.chat.id, member.user.id, is_member_status(member))
 
-    scheduler_task = asyncio.create_task(schedule_loop())
+    dispatcher.chat_member()(chat_member_handler)
+
+    async def my_chat_member_handler(update: ChatMemberUpdated) -> None:
+        handle_my_chat_member(bot.id, update)
+
+    dispatcher.my_chat_member()(my_chat_member_handler)
 
     RUNNING_BOTS[bot.id] = {
         "task": asyncio.current_task(),
         "stop": stop_event,
-        "scheduler": scheduler_task,
         "dispatcher": dispatcher,
         "bot": telegram_bot,
+        "mode": mode,
     }
 
+    warm_chat_admin_cache(bot.id)
+    if bot_user_id is not None:
+        warm_file_id_cache(bot_user_id)
+    resume_broadcast_jobs(bot.id)
+    refresh_bot_schedules(bot.id)
+
+    polling_task: Optional[asyncio.Task] = None
     try:
-        if webhook_url:
-            await telegram_bot.set_webhook(webhook_url, drop_pending_updates=True)
+        if mode == "polling":
+            polling_task = asyncio.create_task(poll_updates(bot, telegram_bot))
+        elif webhook_url:
+            await telegram_bot.set_webhook(
+                webhook_url,
+                drop_pending_updates=True,
+                allowed_updates=dispatcher.resolve_used_update_types(),
+            )
         await stop_event.wait()
     finally:
-        scheduler_task.cancel()
-        try:
-            await telegram_bot.delete_webhook(drop_pending_updates=True)
-        except Exception:
-            pass
-        await telegram_bot.session.close()
+        if polling_task:
+            polling_task.cancel()
+        if mode == "webhook":
+            try:
+                await telegram_bot.delete_webhook(drop_pending_updates=True)
+            except Exception:
+                pass
         RUNNING_BOTS.pop(bot.id, None)
+        refresh_bot_schedules(bot.id)
+        cancel_schedule_tasks(bot.id)
+        cancel_delayed_sends(bot.id)
 
 
 async def stop_bot_task(bot_id: str) -> None:
@@ -2554,7 +3927,6 @@ async def stop_bot_task(bot_id: str) -> None:
         return
     stop_event = entry.get("stop")
     task = entry.get("task")
-    scheduler = entry.get("scheduler")
     telegram_bot = entry.get("bot")
     if isinstance(stop_event, asyncio.Event):
         stop_event.set()
@@ -2567,45 +3939,859 @@ async def stop_bot_task(bot_id: str) -> None:
             pass
         except Exception:
             pass
-    if isinstance(scheduler, asyncio.Task):
-        scheduler.cancel()
-    if isinstance(telegram_bot, TelegramBot):
+    cancel_schedule_tasks(bot_id)
+    cancel_delayed_sends(bot_id)
+    cancel_broadcast_tasks(bot_id)
+    if isinstance(telegram_bot, TelegramBot) and entry.get("mode") != "polling":
         try:
             await telegram_bot.delete_webhook(drop_pending_updates=True)
         except Exception:
             pass
     RUNNING_BOTS.pop(bot_id, None)
+    release_telegram_bot(getattr(telegram_bot, "token", None))
+    refresh_bot_schedules(bot_id)
+
+
+def compute_next_run(
+    config: dict, last_run: Optional[datetime], executed_run_at: Optional[str], now: datetime
+) -> Optional[datetime]:
+    if config["type"] == "interval":
+        if last_run is None:
+            return now
+        return last_run + timedelta(seconds=float(config["seconds"]))
+    zone = config.get("zone")
+    if config["type"] == "daily":
+        local_last = to_zone_time(last_run, zone) if last_run is not None else None
+        candidate = datetime.combine(to_zone_time(now, zone).date(), config["time"])
+        if local_last is not None and local_last.date() >= candidate.date():
+            candidate = datetime.combine(local_last.date() + timedelta(days=1), config["time"])
+        return from_zone_time(candidate, zone)
+    if config["type"] == "datetime":
+        if executed_run_at == config["run_at"].isoformat():
+            return None
+        return from_zone_time(config["run_at"], zone)
+    if config["type"] == "cron":
+        candidate = next_cron_time(config["cron"], to_zone_time(last_run or now, zone))
+        return from_zone_time(candidate, zone) if candidate is not None else None
+    return None
 
 
-@app.get("/health")
-def health() -> dict:
-    return {"status": "ok"}
+def skip_missed_run(config: dict, fire_at: datetime, now: datetime) -> Optional[datetime]:
+    if config["type"] == "interval":
+        seconds = float(config["seconds"])
+        periods = int((now - fire_at).total_seconds() // seconds) + 1
+        return fire_at + timedelta(seconds=periods * seconds)
+    if config["type"] in ("daily", "cron"):
+        return compute_next_run(config, now, None, now)
+    return None
 
 
-@app.get("/plugins")
-def list_plugins() -> List[dict]:
-    return get_plugins_payload()
+def parse_schedule_time(value: Optional[str]) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return None
 
 
-@app.get("/bots/{bot_id}/plugins/counter/{key}")
-def get_counter(bot_id: str, key: str) -> dict:
-    return {"value": get_counter_value(bot_id, key)}
+def load_schedule_state(bot_id: str, node_id: Optional[str] = None) -> Dict[str, sqlite3.Row]:
+    query = "SELECT * FROM schedule_state WHERE bot_id = ?"
+    params: Tuple = (bot_id,)
+    if node_id is not None:
+        query += " AND node_id = ?"
+        params = (bot_id, node_id)
+    with get_connection() as conn:
+        rows = conn.execute(query, params).fetchall()
+    states: Dict[str, sqlite3.Row] = {}
+    for row in rows:
+        key = (bot_id, row["node_id"])
+        last_run = parse_schedule_time(row["last_run"])
+        if last_run is not None:
+            SCHEDULE_LAST_RUN[key] = last_run
+        if row["executed"] and row["executed_run_at"]:
+            SCHEDULE_EXECUTED[key] = row["executed_run_at"]
+        else:
+            SCHEDULE_EXECUTED.pop(key, None)
+        states[row["node_id"]] = row
+    return states
 
 
-@app.post("/webhook/{bot_id}/{node_id}")
-async def incoming_webhook(bot_id: str, node_id: str, payload: dict | list = Body(default=None)) -> dict:
-    bot = get_bot_or_404(bot_id)
-    if not bot.token:
-        raise HTTPException(status_code=400, detail="Bot token missing")
-    flow = FLOW_CACHE.get(bot.id) or bot.flow
-    node = next((n for n in flow.nodes if n.get("id") == node_id), None)
-    if not node:
-        raise HTTPException(status_code=404, detail="Node not found")
-    variables: dict = {}
-    if payload is not None:
-        variables["payload"] = payload
-        flatten_payload("", payload, variables)
-        if isinstance(payload, list):
+def claim_schedule(
+    bot_id: str, node_id: str, expected: Optional[datetime], fired_at: datetime, executed_run_at: Optional[str]
+) -> Optional[float]:
+    lease_until = time.time() + SCHEDULE_LEASE_SECONDS
+    with get_connection() as conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO schedule_state (bot_id, node_id) VALUES (?, ?)",
+            (bot_id, node_id),
+        )
+        cursor = conn.execute(
+            """
+            UPDATE schedule_state
+            SET last_run = ?, executed = ?, executed_run_at = ?, lease_owner = ?, lease_until = ?,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE bot_id = ? AND node_id = ? AND last_run IS ?
+              AND (lease_owner IS NULL OR lease_owner = ? OR lease_until < ?)
+            """,
+            (
+                fired_at.isoformat(),
+                1 if executed_run_at else 0,
+                executed_run_at,
+                WORKER_ID,
+                lease_until,
+                bot_id,
+                node_id,
+                expected.isoformat() if expected else None,
+                WORKER_ID,
+                time.time(),
+            ),
+        )
+        conn.commit()
+    return lease_until if cursor.rowcount else None
+
+
+def renew_schedule_lease(bot_id: str, node_id: str) -> bool:
+    with get_connection() as conn:
+        cursor = conn.execute(
+            """
+            UPDATE schedule_state SET lease_until = ?
+            WHERE bot_id = ? AND node_id = ? AND lease_owner = ?
+            """,
+            (time.time() + SCHEDULE_LEASE_SECONDS, bot_id, node_id, WORKER_ID),
+        )
+        conn.commit()
+    return bool(cursor.rowcount)
+
+
+async def keep_schedule_lease(bot_id: str, node_id: str) -> None:
+    while True:
+        await asyncio.sleep(max(1.0, SCHEDULE_LEASE_SECONDS / 3))
+        try:
+            if not renew_schedule_lease(bot_id, node_id):
+                print(f"schedule lease lost for {node_id}")
+        except Exception as exc:
+            print(f"schedule lease renewal failed for {node_id}: {exc}")
+
+
+def release_schedule_lease(bot_id: str, node_id: str) -> None:
+    with get_connection() as conn:
+        conn.execute(
+            """
+            UPDATE schedule_state SET lease_owner = NULL, lease_until = NULL
+            WHERE bot_id = ? AND node_id = ? AND lease_owner = ?
+            """,
+            (bot_id, node_id, WORKER_ID),
+        )
+        conn.commit()
+
+
+def record_schedule_run(run_id: str, bot_id: str, node_id: str, status: str) -> None:
+    with get_connection() as conn:
+        conn.execute(
+            "INSERT INTO schedule_runs (id, bot_id, node_id, status) VALUES (?, ?, ?, ?)",
+            (run_id, bot_id, node_id, status),
+        )
+        conn.commit()
+    SCHEDULE_RUNS_STATE["inserts"] += 1
+    if SCHEDULE_RUNS_STATE["inserts"] % SCHEDULE_RUNS_PRUNE_EVERY == 0:
+        prune_schedule_runs(bot_id)
+
+
+def prune_schedule_runs(bot_id: str) -> None:
+    try:
+        with get_connection() as conn:
+            conn.execute(
+                """
+                DELETE FROM schedule_runs
+                WHERE created_at < datetime('now', ?) AND status NOT IN ('queued', 'running')
+                """,
+                (f"-{SCHEDULE_RUNS_RETENTION_DAYS} days",),
+            )
+            conn.execute(
+                """
+                DELETE FROM schedule_runs WHERE bot_id = ? AND status NOT IN ('queued', 'running') AND rowid <= (
+                    SELECT rowid FROM schedule_runs WHERE bot_id = ? ORDER BY rowid DESC LIMIT 1 OFFSET ?
+                )
+                """,
+                (bot_id, bot_id, SCHEDULE_RUNS_MAX_ROWS),
+            )
+            conn.commit()
+    except Exception as exc:
+        print(f"schedule runs prune failed: {exc}")
+
+
+@app.on_event("startup")
+def mark_stale_schedule_runs() -> None:
+    with get_connection() as conn:
+        conn.execute(
+            """
+            UPDATE schedule_runs SET status = 'interrupted', finished_at = ?
+            WHERE status IN ('queued', 'running') AND NOT EXISTS (
+                SELECT 1 FROM schedule_state s
+                WHERE s.bot_id = schedule_runs.bot_id AND s.node_id = schedule_runs.node_id
+                  AND s.lease_owner IS NOT NULL AND s.lease_owner != ? AND s.lease_until > ?
+            )
+            """,
+            (datetime.now().isoformat(), WORKER_ID, time.time()),
+        )
+        conn.commit()
+
+
+def start_schedule_run(run_id: str, started_at: datetime) -> None:
+    with get_connection() as conn:
+        conn.execute(
+            "UPDATE schedule_runs SET status = 'running', started_at = ? WHERE id = ?",
+            (started_at.isoformat(), run_id),
+        )
+        conn.commit()
+
+
+def finish_schedule_run(run_id: str, status: str, error: Optional[str], started_at: Optional[datetime]) -> None:
+    finished_at = datetime.now()
+    duration = (finished_at - started_at).total_seconds() if started_at else None
+    with get_connection() as conn:
+        conn.execute(
+            """
+            UPDATE schedule_runs SET status = ?, error = ?, finished_at = ?, duration = ?
+            WHERE id = ?
+            """,
+            (status, error, finished_at.isoformat(), duration, run_id),
+        )
+        conn.commit()
+
+
+def push_schedule(bot_id: str, node_id: str, fire_at: datetime) -> None:
+    SCHEDULER_STATE["sequence"] += 1
+    entry = (fire_at.timestamp(), SCHEDULER_STATE["sequence"], bot_id, node_id, SCHEDULE_GENERATIONS.get(bot_id, 0))
+    heapq.heappush(SCHEDULE_HEAP, entry)
+
+
+def get_bot_flow(bot_id: str) -> Optional[Flow]:
+    flow = FLOW_CACHE.get(bot_id)
+    if flow is None:
+        with get_connection() as conn:
+            row = conn.execute("SELECT * FROM bots WHERE id = ?", (bot_id,)).fetchone()
+        if not row:
+            return None
+        flow = row_to_bot(row).flow
+        FLOW_CACHE[bot_id] = flow
+    return flow
+
+
+def refresh_bot_schedules(bot_id: str) -> None:
+    SCHEDULE_GENERATIONS[bot_id] = SCHEDULE_GENERATIONS.get(bot_id, 0) + 1
+    SCHEDULE_HEAP[:] = [item for item in SCHEDULE_HEAP if item[2] != bot_id]
+    heapq.heapify(SCHEDULE_HEAP)
+    flow = get_bot_flow(bot_id) if bot_id in RUNNING_BOTS else None
+    if flow is not None:
+        load_schedule_state(bot_id)
+        now = datetime.now()
+        for node_id, config in get_compiled_flow(flow).schedules:
+            key = (bot_id, node_id)
+            last_run = SCHEDULE_LAST_RUN.get(key)
+            fire_at = compute_next_run(config, last_run, SCHEDULE_EXECUTED.get(key), now)
+            if (
+                fire_at is not None
+                and config.get("missed") == "skip"
+                and (last_run is not None or config["type"] == "datetime")
+                and (now - fire_at).total_seconds() > SCHEDULE_MISSED_GRACE_SECONDS
+            ):
+                fire_at = skip_missed_run(config, fire_at, now)
+            if fire_at is not None:
+                push_schedule(bot_id, node_id, fire_at)
+    wake_scheduler()
+
+
+def wake_scheduler() -> None:
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    task = SCHEDULER_STATE["task"]
+    if task is None or task.done():
+        SCHEDULER_STATE["wakeup"] = asyncio.Event()
+        SCHEDULER_STATE["task"] = asyncio.create_task(scheduler_loop())
+    SCHEDULER_STATE["wakeup"].set()
+
+
+async def scheduler_loop() -> None:
+    wakeup: asyncio.Event = SCHEDULER_STATE["wakeup"]
+    while True:
+        wakeup.clear()
+        if not SCHEDULE_HEAP:
+            await wakeup.wait()
+            continue
+        fire_at, _, bot_id, node_id, generation = SCHEDULE_HEAP[0]
+        delay = fire_at - time.time()
+        if delay > 0:
+            timer = asyncio.get_running_loop().call_later(delay, wakeup.set)
+            try:
+                await wakeup.wait()
+            finally:
+                timer.cancel()
+            continue
+        heapq.heappop(SCHEDULE_HEAP)
+        if generation != SCHEDULE_GENERATIONS.get(bot_id):
+            continue
+        try:
+            fire_schedule(bot_id, node_id)
+        except Exception as exc:
+            print(f"scheduler error for {node_id}: {exc}")
+
+
+def fire_schedule(bot_id: str, node_id: str) -> None:
+    flow = get_bot_flow(bot_id)
+    entry = RUNNING_BOTS.get(bot_id)
+    if flow is None or not entry:
+        return
+    config = dict(get_compiled_flow(flow).schedules).get(node_id)
+    if not config:
+        return
+    key = (bot_id, node_id)
+    now = datetime.now()
+    executed_run_at = config["run_at"].isoformat() if config["type"] == "datetime" else None
+    try:
+        lease_until = claim_schedule(bot_id, node_id, SCHEDULE_LAST_RUN.get(key), now, executed_run_at)
+        row = load_schedule_state(bot_id, node_id).get(node_id) if lease_until is None else None
+    except Exception as exc:
+        print(f"schedule claim failed for {node_id}: {exc}")
+        push_schedule(bot_id, node_id, now + timedelta(seconds=SCHEDULE_RETRY_SECONDS))
+        return
+    if lease_until is None:
+        next_run = compute_next_run(config, SCHEDULE_LAST_RUN.get(key), SCHEDULE_EXECUTED.get(key), now)
+        if row and row["lease_owner"] and row["lease_owner"] != WORKER_ID and row["lease_until"]:
+            held_until = datetime.fromtimestamp(row["lease_until"])
+            if next_run is not None and next_run < held_until:
+                next_run = held_until
+        if next_run is not None:
+            push_schedule(bot_id, node_id, next_run)
+        return
+    SCHEDULE_LAST_RUN[key] = now
+    if executed_run_at:
+        SCHEDULE_EXECUTED[key] = executed_run_at
+    next_run = compute_next_run(config, now, SCHEDULE_EXECUTED.get(key), now)
+    if next_run is not None:
+        push_schedule(bot_id, node_id, next_run)
+    run_id = uuid.uuid4().hex
+    active = SCHEDULE_ACTIVE.get(key, 0)
+    if active and config["overrun"] == "skip":
+        record_schedule_run(run_id, bot_id, node_id, "skipped")
+        return
+    if active > 1:
+        return
+    record_schedule_run(run_id, bot_id, node_id, "queued")
+    SCHEDULE_ACTIVE[key] = active + 1
+    if not active:
+        SCHEDULE_LEASE_RENEWALS[key] = asyncio.create_task(keep_schedule_lease(bot_id, node_id))
+    task = asyncio.create_task(run_scheduled_job(bot_id, node_id, flow, entry.get("bot"), run_id))
+    tasks = SCHEDULE_TASKS.setdefault(bot_id, set())
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
+    task.add_done_callback(lambda _: finish_scheduled_job(bot_id, node_id, run_id))
+
+
+def finish_scheduled_job(bot_id: str, node_id: str, run_id: str) -> None:
+    key = (bot_id, node_id)
+    try:
+        with get_connection() as conn:
+            conn.execute(
+                "UPDATE schedule_runs SET status = 'cancelled', finished_at = ? WHERE id = ? AND status = 'queued'",
+                (datetime.now().isoformat(), run_id),
+            )
+            conn.commit()
+    except Exception as exc:
+        print(f"schedule run update failed for {node_id}: {exc}")
+    remaining = SCHEDULE_ACTIVE.get(key, 1) - 1
+    if remaining > 0:
+        SCHEDULE_ACTIVE[key] = remaining
+        return
+    SCHEDULE_ACTIVE.pop(key, None)
+    SCHEDULE_NODE_LOCKS.pop(key, None)
+    renewal = SCHEDULE_LEASE_RENEWALS.pop(key, None)
+    if renewal is not None:
+        renewal.cancel()
+    release_schedule_lease(bot_id, node_id)
+
+
+async def run_scheduled_job(
+    bot_id: str, node_id: str, flow: Flow, telegram_bot: TelegramBot, run_id: str
+) -> None:
+    SEND_PRIORITY.set("scheduled")
+    key = (bot_id, node_id)
+    node_lock = SCHEDULE_NODE_LOCKS.setdefault(key, asyncio.Lock())
+    semaphore = SCHEDULE_SEMAPHORES.setdefault(bot_id, asyncio.Semaphore(SCHEDULE_CONCURRENCY))
+    status = "failed"
+    error: Optional[str] = None
+    started_at: Optional[datetime] = None
+    try:
+        async with node_lock:
+            async with semaphore:
+                started_at = datetime.now()
+                start_schedule_run(run_id, started_at)
+                targets = await collect_scheduled_targets(flow, node_id, bot_id, telegram_bot)
+                await send_scheduled_targets_with_delay(flow, telegram_bot, targets, bot_id)
+                status = "done"
+    except asyncio.CancelledError:
+        status = "cancelled"
+        raise
+    except Exception as exc:
+        error = str(exc)
+        print(f"schedule loop error for {node_id}: {exc}")
+    finally:
+        if started_at is not None:
+            finish_schedule_run(run_id, status, error, started_at)
+
+
+def cancel_schedule_tasks(bot_id: str) -> None:
+    for task in list(SCHEDULE_TASKS.pop(bot_id, None) or ()):
+        task.cancel()
+
+
+def get_broadcast_job(job_id: str) -> Optional[dict]:
+    with get_connection() as conn:
+        row = conn.execute("SELECT * FROM broadcast_jobs WHERE id = ?", (job_id,)).fetchone()
+        if not row:
+            return None
+        counts = {
+            state: count
+            for state, count in conn.execute(
+                "SELECT state, COUNT(*) FROM broadcast_deliveries WHERE job_id = ? GROUP BY state",
+                (job_id,),
+            ).fetchall()
+        }
+    return {
+        "id": row["id"],
+        "bot_id": row["bot_id"],
+        "status": row["status"],
+        "status_filter": row["status_filter"],
+        "total": row["total"] or 0,
+        "sent": counts.get("sent", 0),
+        "failed": counts.get("failed", 0),
+        "remaining": counts.get("pending", 0),
+        "created_at": row["created_at"],
+        "updated_at": row["updated_at"],
+    }
+
+
+def create_broadcast_job(
+    bot_id: str,
+    message_text: str,
+    status_filter: Optional[str] = None,
+    parse_mode: Optional[str] = None,
+) -> dict:
+    job_id = uuid.uuid4().hex
+    wanted = status_filter.strip().lower() if status_filter is not None else None
+    with get_connection() as conn:
+        rows = conn.execute(
+            """
+            SELECT user_id, status FROM user_status
+            WHERE bot_id = ? AND COALESCE(blocked, 0) = 0
+            ORDER BY user_id ASC
+            """,
+            (bot_id,),
+        ).fetchall()
+        recipients = [
+            (job_id, row["user_id"])
+            for row in rows
+            if wanted is None or (row["status"] or "").strip().lower() == wanted
+        ]
+        conn.execute(
+            """
+            INSERT INTO broadcast_jobs (id, bot_id, status, message_text, parse_mode, status_filter, total)
+            VALUES (?, ?, 'running', ?, ?, ?, ?)
+            """,
+            (job_id, bot_id, message_text, parse_mode, status_filter, len(recipients)),
+        )
+        conn.executemany("INSERT INTO broadcast_deliveries (job_id, user_id) VALUES (?, ?)", recipients)
+        conn.commit()
+    return get_broadcast_job(job_id)
+
+
+def set_broadcast_status(job_id: str, status: str, expected: Tuple[str, ...]) -> bool:
+    placeholders = ", ".join("?" for _ in expected)
+    with get_connection() as conn:
+        cursor = conn.execute(
+            f"UPDATE broadcast_jobs SET status = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ? AND status IN ({placeholders})",
+            (status, job_id, *expected),
+        )
+        conn.commit()
+    return cursor.rowcount > 0
+
+
+def list_pending_deliveries(job_id: str, bot_id: str) -> List[sqlite3.Row]:
+    with get_connection() as conn:
+        return conn.execute(
+            """
+            SELECT d.user_id, u.username, u.first_name, u.last_name
+            FROM broadcast_deliveries d
+            LEFT JOIN user_status u ON u.bot_id = ? AND u.user_id = d.user_id
+            WHERE d.job_id = ? AND d.state = 'pending'
+            ORDER BY d.user_id ASC
+            LIMIT ?
+            """,
+            (bot_id, job_id, BROADCAST_BATCH_SIZE),
+        ).fetchall()
+
+
+def record_deliveries(job_id: str, results: List[Tuple[str, Optional[str], int]]) -> None:
+    with get_connection() as conn:
+        conn.executemany(
+            """
+            UPDATE broadcast_deliveries
+            SET state = ?, error = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE job_id = ? AND user_id = ?
+            """,
+            [(state, error, job_id, user_id) for state, error, user_id in results],
+        )
+        conn.execute("UPDATE broadcast_jobs SET updated_at = CURRENT_TIMESTAMP WHERE id = ?", (job_id,))
+        conn.commit()
+
+
+def render_broadcast_text(message_text: str, row: sqlite3.Row) -> str:
+    fake_message = type("Obj", (), {"chat": type("Obj", (), {"id": row["user_id"]})()})()
+    user_obj = type(
+        "Obj",
+        (),
+        {
+            "id": row["user_id"],
+            "username": row["username"],
+            "first_name": row["first_name"],
+            "last_name": row["last_name"],
+        },
+    )()
+    return render_template(message_text, fake_message, user_obj, row["user_id"])
+
+
+async def run_broadcast_job(job_id: str, bot_id: str) -> None:
+    SEND_PRIORITY.set("broadcast")
+    with get_connection() as conn:
+        job_row = conn.execute("SELECT * FROM broadcast_jobs WHERE id = ?", (job_id,)).fetchone()
+        bot_row = conn.execute("SELECT token FROM bots WHERE id = ?", (bot_id,)).fetchone()
+    if not job_row or not bot_row or not bot_row["token"]:
+        return
+    telegram_bot = get_telegram_bot(bot_row["token"])
+    message_text = job_row["message_text"]
+    parse_mode = job_row["parse_mode"] or None
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    pending: List[Tuple[str, Optional[str], int]] = []
+    flushed = {"at": time.monotonic()}
+
+    def flush() -> None:
+        flushed["at"] = time.monotonic()
+        if pending:
+            results = pending[:]
+            pending.clear()
+            record_deliveries(job_id, results)
+
+    async def send(row: sqlite3.Row) -> Tuple[str, Optional[str], int]:
+        try:
+            rendered = render_broadcast_text(message_text, row)
+            if not rendered:
+                return "failed", "empty message", row["user_id"]
+            await telegram_bot.send_message(row["user_id"], rendered, parse_mode=parse_mode)
+            return "sent", None, row["user_id"]
+        except Exception as exc:
+            if is_blocked_error(exc):
+                mark_user_blocked(bot_id, row["user_id"])
+            return "failed", str(exc), row["user_id"]
+
+    async def deliver(row: sqlite3.Row) -> None:
+        async with semaphore:
+            pending.append(await send(row))
+        if len(pending) >= BROADCAST_FLUSH_SIZE or time.monotonic() - flushed["at"] >= BROADCAST_FLUSH_SECONDS:
+            flush()
+
+    try:
+        while True:
+            job = get_broadcast_job(job_id)
+            if not job or job["status"] != "running":
+                return
+            rows = list_pending_deliveries(job_id, bot_id)
+            if not rows:
+                set_broadcast_status(job_id, "done", ("running",))
+                return
+            await asyncio.gather(*(deliver(row) for row in rows))
+            flush()
+    except Exception as exc:
+        print(f"broadcast {job_id} failed: {exc}")
+    finally:
+        try:
+            flush()
+        except Exception as exc:
+            print(f"broadcast {job_id} flush failed: {exc}")
+        tasks = BROADCAST_TASKS.get(bot_id) or {}
+        if tasks.get(job_id) is asyncio.current_task():
+            tasks.pop(job_id, None)
+
+
+def start_broadcast_job(job_id: str, bot_id: str) -> None:
+    tasks = BROADCAST_TASKS.setdefault(bot_id, {})
+    running = tasks.get(job_id)
+    if running and not running.done():
+        return
+    tasks[job_id] = asyncio.create_task(run_broadcast_job(job_id, bot_id))
+
+
+def resume_broadcast_jobs(bot_id: str) -> None:
+    with get_connection() as conn:
+        rows = conn.execute(
+            "SELECT id FROM broadcast_jobs WHERE bot_id = ? AND status = 'running'",
+            (bot_id,),
+        ).fetchall()
+    for row in rows:
+        start_broadcast_job(row["id"], bot_id)
+
+
+def cancel_broadcast_tasks(bot_id: str) -> None:
+    for task in (BROADCAST_TASKS.pop(bot_id, None) or {}).values():
+        task.cancel()
+
+
+def build_broadcast_starter(bot_id: str) -> Callable[..., dict]:
+    def broadcast(message_text: str, status: Optional[str] = None, parse_mode: Optional[str] = None) -> dict:
+        job = create_broadcast_job(str(bot_id), message_text, status, parse_mode)
+        start_broadcast_job(job["id"], job["bot_id"])
+        return job
+
+    return broadcast
+
+
+UPLOAD_REFERENCE_PATTERN = re.compile(r"/uploads/([^\s\"'?#]+)")
+
+
+def build_reference_index() -> dict:
+    uploads: set[str] = set()
+    files: set[str] = set()
+    kept: set[str] = set()
+    with get_connection() as conn:
+        rows = conn.execute("SELECT id, flow FROM bots").fetchall()
+    for row in rows:
+        raw_flow = row["flow"] or ""
+        for match in UPLOAD_REFERENCE_PATTERN.finditer(raw_flow):
+            name = normalize_upload_name(match.group(1))
+            if name:
+                uploads.add(name)
+        try:
+            flow = json.loads(raw_flow) if raw_flow else {}
+            if not isinstance(flow, dict):
+                raise ValueError("flow is not an object")
+        except ValueError as exc:
+            print(f"gc skipped unreadable flow for bot {row['id']}: {exc}")
+            kept.add(f"{sanitize_filename(row['id'])}__")
+            continue
+        for node in flow.get("nodes") or []:
+            data = node.get("data") or {}
+            kind = data.get("kind")
+            field = MEDIA_URL_FIELDS.get(kind)
+            if field:
+                for url in data.get(field) or []:
+                    name = get_upload_name(url.strip()) if isinstance(url, str) else ""
+                    if name:
+                        uploads.add(name)
+            if kind == "excel_file":
+                files.add(os.path.abspath(get_excel_path(row["id"], data.get("fileName") or "data")))
+            elif kind == "text_file":
+                files.add(os.path.abspath(get_text_path(row["id"], data.get("fileName") or "data")))
+    return {"uploads": uploads, "files": files, "kept": tuple(kept)}
+
+
+def list_gc_candidates(index: dict) -> List[Tuple[str, str, str]]:
+    candidates: List[Tuple[str, str, str]] = []
+    with UPLOAD_MANIFEST_LOCK:
+        entries = list(UPLOAD_MANIFEST.items())
+    for name, entry in entries:
+        if name not in index["uploads"]:
+            candidates.append(("uploads", name, entry["path"]))
+    for area, directory in (("excel", EXCEL_DIR), ("text", TEXT_DIR), ("tmp", UPLOAD_TMP_DIR)):
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            continue
+        for name in names:
+            path = os.path.abspath(os.path.join(directory, name))
+            if index["kept"] and name.startswith(index["kept"]):
+                continue
+            if os.path.isfile(path) and path not in index["files"]:
+                candidates.append((area, name, path))
+    return candidates
+
+
+def purge_trash(now: float) -> int:
+    purged = 0
+    try:
+        batches = os.listdir(TRASH_DIR)
+    except OSError:
+        return 0
+    for batch in batches:
+        try:
+            moved_at = float(batch)
+        except ValueError:
+            continue
+        if now - moved_at < GC_GRACE_SECONDS:
+            continue
+        shutil.rmtree(os.path.join(TRASH_DIR, batch), ignore_errors=True)
+        purged += 1
+    return purged
+
+
+async def collect_garbage() -> dict:
+    index = await asyncio.to_thread(build_reference_index)
+    now = time.time()
+    batch_dir = os.path.join(TRASH_DIR, str(int(now)))
+    moved = 0
+    for area, name, path in list_gc_candidates(index):
+        if moved >= GC_BATCH_SIZE:
+            break
+        try:
+            if now - os.stat(path).st_mtime < GC_MIN_AGE_SECONDS:
+                continue
+            if area == "tmp":
+                os.remove(path)
+            else:
+                target = os.path.join(batch_dir, area, name)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.move(path, target)
+        except OSError as exc:
+            print(f"gc failed for {path}: {exc}")
+            continue
+        if area == "uploads":
+            unregister_upload(name)
+        moved += 1
+        await asyncio.sleep(GC_PAUSE_SECONDS)
+    purged = await asyncio.to_thread(purge_trash, now)
+    return {"moved": moved, "purged_batches": purged}
+
+
+async def garbage_collection_loop() -> None:
+    while True:
+        await asyncio.sleep(GC_INTERVAL_SECONDS)
+        try:
+            await collect_garbage()
+        except Exception as exc:
+            print(f"gc run failed: {exc}")
+
+
+@app.on_event("startup")
+async def start_garbage_collection() -> None:
+    if GC_INTERVAL_SECONDS > 0:
+        asyncio.create_task(garbage_collection_loop())
+
+
+@app.post("/maintenance/gc")
+async def run_garbage_collection() -> dict:
+    return await collect_garbage()
+
+
+@app.get("/health")
+def health() -> dict:
+    return {"status": "ok"}
+
+
+@app.get("/plugins")
+def list_plugins() -> List[dict]:
+    return get_plugins_payload()
+
+
+@app.get("/bots/{bot_id}/plugins/counter/{key}")
+def get_counter(bot_id: str, key: str) -> dict:
+    return {"value": get_counter_value(bot_id, key)}
+
+
+@app.get("/bots/{bot_id}/media/prewarm")
+def get_media_prewarm(bot_id: str) -> dict:
+    get_bot_or_404(bot_id)
+    progress = PREWARM_PROGRESS.get(bot_id) or {"status": "idle", "total": 0, "uploaded": 0, "cached": 0, "failed": 0}
+    return {"enabled": bool(PREWARM_CHAT_ID), **progress}
+
+
+@app.get("/bots/{bot_id}/dead-letters")
+def list_dead_letters(bot_id: str, limit: int = 100) -> List[dict]:
+    get_bot_or_404(bot_id)
+    with get_connection() as conn:
+        rows = conn.execute(
+            "SELECT * FROM dead_letters WHERE bot_id = ? ORDER BY id DESC LIMIT ?",
+            (bot_id, max(1, min(limit, 1000))),
+        ).fetchall()
+    return [dict(row) for row in rows]
+
+
+@app.get("/bots/{bot_id}/schedule-runs")
+def list_schedule_runs(bot_id: str, limit: int = 100) -> List[dict]:
+    get_bot_or_404(bot_id)
+    with get_connection() as conn:
+        rows = conn.execute(
+            "SELECT * FROM schedule_runs WHERE bot_id = ? ORDER BY created_at DESC, rowid DESC LIMIT ?",
+            (bot_id, max(1, min(limit, 1000))),
+        ).fetchall()
+    return [dict(row) for row in rows]
+
+
+@app.get("/bots/{bot_id}/outbound")
+def get_outbound_queue(bot_id: str) -> dict:
+    bot = get_bot_or_404(bot_id)
+    try:
+        telegram_bot_id = int((bot.token or "").split(":", 1)[0])
+    except ValueError:
+        telegram_bot_id = None
+    limiter = RATE_LIMITERS.get(telegram_bot_id)
+    depth = limiter["queue"].depth() if limiter else {name: 0 for name in SEND_PRIORITY_WEIGHTS}
+    return {"depth": depth, "weights": SEND_PRIORITY_WEIGHTS}
+
+
+def get_broadcast_or_404(bot_id: str, job_id: str) -> dict:
+    get_bot_or_404(bot_id)
+    job = get_broadcast_job(job_id)
+    if not job or job["bot_id"] != bot_id:
+        raise HTTPException(status_code=404, detail="Broadcast not found")
+    return job
+
+
+@app.get("/bots/{bot_id}/broadcasts/{job_id}")
+def get_broadcast(bot_id: str, job_id: str) -> dict:
+    return get_broadcast_or_404(bot_id, job_id)
+
+
+@app.post("/bots/{bot_id}/broadcasts/{job_id}/pause")
+def pause_broadcast(bot_id: str, job_id: str) -> dict:
+    get_broadcast_or_404(bot_id, job_id)
+    if not set_broadcast_status(job_id, "paused", ("running",)):
+        raise HTTPException(status_code=409, detail="Broadcast is not running")
+    return get_broadcast_job(job_id)
+
+
+@app.post("/bots/{bot_id}/broadcasts/{job_id}/resume")
+async def resume_broadcast(bot_id: str, job_id: str) -> dict:
+    get_broadcast_or_404(bot_id, job_id)
+    if not set_broadcast_status(job_id, "running", ("paused", "running")):
+        raise HTTPException(status_code=409, detail="Broadcast is not paused")
+    start_broadcast_job(job_id, bot_id)
+    return get_broadcast_job(job_id)
+
+
+@app.post("/bots/{bot_id}/broadcasts/{job_id}/cancel")
+def cancel_broadcast(bot_id: str, job_id: str) -> dict:
+    get_broadcast_or_404(bot_id, job_id)
+    if not set_broadcast_status(job_id, "cancelled", ("running", "paused")):
+        raise HTTPException(status_code=409, detail="Broadcast is already finished")
+    return get_broadcast_job(job_id)
+
+
+@app.post("/webhook/{bot_id}/{node_id}")
+async def incoming_webhook(bot_id: str, node_id: str, payload: dict | list = Body(default=None)) -> dict:
+    bot = get_bot_or_404(bot_id)
+    if not bot.token:
+        raise HTTPException(status_code=400, detail="Bot token missing")
+    SEND_PRIORITY.set("webhook")
+    flow = FLOW_CACHE.get(bot.id) or bot.flow
+    node = next((n for n in flow.nodes if n.get("id") == node_id), None)
+    if not node:
+        raise HTTPException(status_code=404, detail="Node not found")
+    variables: dict = {}
+    if payload is not None:
+        variables["payload"] = payload
+        flatten_payload("", payload, variables)
+        if isinstance(payload, list):
             variables["array"] = payload
             variables["array_len"] = len(payload)
     targets = await collect_content_targets_with_delay(
@@ -2616,34 +4802,89 @@ async def incoming_webhook(bot_id: str, node_id: str, payload: dict | list = Bod
         user_id=None,
         initial_vars=variables,
     )
-    telegram_bot = TelegramBot(bot.token)
+    telegram_bot = get_telegram_bot(bot.token)
     errors: list = []
-    try:
-        ordered = sorted(targets, key=lambda item: item[1])
-        elapsed = 0.0
-        for target_node, delay, target_chat_id, row_data, extra_vars in ordered:
-            wait_time = delay - elapsed
-            if wait_time > 0:
-                await asyncio.sleep(wait_time)
-                elapsed = delay
-            chat_id = target_chat_id
-            if chat_id is None:
-                chat_id = extra_vars.get("chat_id") or extra_vars.get("chatId")
-            if chat_id is None:
-                continue
-            try:
-                await send_content_node_to_chat(flow, telegram_bot, int(chat_id), target_node, None, row_data, extra_vars)
-            except Exception as exc:
-                errors.append({"chat_id": chat_id, "error": str(exc)})
-    finally:
-        await telegram_bot.session.close()
+    ordered = sorted(targets, key=lambda item: item[1])
+    elapsed = 0.0
+    for target_node, delay, target_chat_id, row_data, extra_vars in ordered:
+        wait_time = delay - elapsed
+        if wait_time > 0:
+            await asyncio.sleep(wait_time)
+            elapsed = delay
+        chat_id = target_chat_id
+        if chat_id is None:
+            chat_id = extra_vars.get("chat_id") or extra_vars.get("chatId")
+        if chat_id is None:
+            continue
+        try:
+            chat_id = int(chat_id)
+            await send_content_node_to_chat(flow, telegram_bot, chat_id, target_node, None, row_data, extra_vars)
+        except Exception as exc:
+            errors.append({"chat_id": chat_id, "error": str(exc), "kind": classify_send_error(exc)})
+            failed_chat_id = chat_id if isinstance(chat_id, int) else None
+            handle_send_failure(bot.id, failed_chat_id, target_node.get("id"), "webhook", exc)
     if errors:
         return {"status": "partial", "errors": errors}
     return {"status": "ok"}
 
 
+def get_token_bot_id(token: str) -> Optional[int]:
+    try:
+        return int(token.split(":", 1)[0])
+    except ValueError:
+        return None
+
+
+def mark_update_seen(telegram_bot_id: int, update_id: int) -> bool:
+    seen = SEEN_UPDATES.get(telegram_bot_id)
+    if seen is None:
+        seen = LRUCache(UPDATE_DEDUP_SIZE)
+        SEEN_UPDATES[telegram_bot_id] = seen
+    if update_id in seen:
+        return False
+    if UPDATE_DEDUP_PERSIST:
+        with get_connection() as conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO processed_updates (telegram_bot_id, update_id) VALUES (?, ?)",
+                (telegram_bot_id, update_id),
+            )
+            writes = SEEN_UPDATE_WRITES.get(telegram_bot_id, 0) + cursor.rowcount
+            SEEN_UPDATE_WRITES[telegram_bot_id] = writes
+            if writes >= UPDATE_DEDUP_PRUNE_EVERY:
+                SEEN_UPDATE_WRITES[telegram_bot_id] = 0
+                conn.execute(
+                    "DELETE FROM processed_updates WHERE telegram_bot_id = ? AND update_id <= ?",
+                    (telegram_bot_id, update_id - UPDATE_DEDUP_SIZE),
+                )
+            conn.commit()
+        if cursor.rowcount == 0:
+            seen.set(update_id, True)
+            return False
+    seen.set(update_id, True)
+    return True
+
+
+def unmark_update(telegram_bot_id: int, update_id: int) -> None:
+    seen = SEEN_UPDATES.get(telegram_bot_id)
+    if seen is not None:
+        seen.pop(update_id)
+    if UPDATE_DEDUP_PERSIST:
+        with get_connection() as conn:
+            conn.execute(
+                "DELETE FROM processed_updates WHERE telegram_bot_id = ? AND update_id = ?",
+                (telegram_bot_id, update_id),
+            )
+            conn.commit()
+
+
 @app.post("/webhook/{token}")
 async def telegram_webhook(token: str, update: dict = Body(...)) -> dict:
+    telegram_bot_id = get_token_bot_id(token)
+    update_id = update.get("update_id")
+    if telegram_bot_id is None or not isinstance(update_id, int):
+        update_id = None
+    elif update_id in SEEN_UPDATES.get(telegram_bot_id, ()):
+        return {"ok": True, "duplicate": True}
     bot = get_bot_by_token(token)
     if not bot:
         raise HTTPException(status_code=404, detail="Bot not found")
@@ -2658,18 +4899,37 @@ async def telegram_webhook(token: str, update: dict = Body(...)) -> dict:
         update_obj = Update.model_validate(update)
     except Exception:
         update_obj = Update(**update)
-    await dispatcher.feed_update(telegram_bot, update_obj)
+    if update_id is not None and not mark_update_seen(telegram_bot_id, update_id):
+        return {"ok": True, "duplicate": True}
+    try:
+        get_ingest_queue().put_nowait((bot.id, update_obj))
+    except asyncio.QueueFull:
+        if update_id is not None:
+            unmark_update(telegram_bot_id, update_id)
+        raise HTTPException(status_code=429, detail="Update queue is full", headers={"Retry-After": "1"})
     return {"ok": True}
 
 
+@app.get("/ingest")
+def get_ingest_status() -> dict:
+    queue = INGEST_STATE["queue"]
+    executor = INGEST_STATE["executor"]
+    return {
+        "depth": queue.qsize() if queue is not None else 0,
+        "capacity": INGEST_QUEUE_SIZE,
+        "chat_concurrency": CHAT_CONCURRENCY,
+        **(executor.stats() if executor else {"active_chats": 0, "waiting_chats": 0, "buffered": 0}),
+    }
+
+
 @app.post("/bots", response_model=Bot)
 def create_bot(payload: BotCreate) -> Bot:
     bot_id = str(uuid.uuid4())
     flow = Flow().model_dump()
     with get_connection() as conn:
         conn.execute(
-            "INSERT INTO bots (id, name, token, status, flow) VALUES (?, ?, ?, ?, ?)",
-            (bot_id, payload.name, payload.token, "stopped", json.dumps(flow)),
+            "INSERT INTO bots (id, name, token, status, mode, flow) VALUES (?, ?, ?, ?, ?, ?)",
+            (bot_id, payload.name, payload.token, "stopped", payload.mode, json.dumps(flow)),
         )
         conn.commit()
     return get_bot_or_404(bot_id)
@@ -2790,17 +5050,23 @@ def update_bot(bot_id: str, payload: BotUpdate) -> Bot:
     data.update(update)
     updated = Bot(**data)
     update_bot_row(updated)
+    if bot.token != updated.token:
+        release_telegram_bot(bot.token)
     return updated
 
 
 @app.delete("/bots/{bot_id}")
 def delete_bot(bot_id: str) -> dict:
     with get_connection() as conn:
-        row = conn.execute("SELECT 1 FROM bots WHERE id = ?", (bot_id,)).fetchone()
+        row = conn.execute("SELECT token FROM bots WHERE id = ?", (bot_id,)).fetchone()
         if not row:
             raise HTTPException(status_code=404, detail="Bot not found")
         conn.execute("DELETE FROM bots WHERE id = ?", (bot_id,))
+        conn.execute("DELETE FROM dead_letters WHERE bot_id = ?", (bot_id,))
+        conn.execute("DELETE FROM schedule_runs WHERE bot_id = ?", (bot_id,))
+        conn.execute("DELETE FROM schedule_state WHERE bot_id = ?", (bot_id,))
         conn.commit()
+    release_telegram_bot(row["token"])
     asyncio.create_task(stop_bot_task(bot_id))
     return {"deleted": True}
 
@@ -2811,6 +5077,8 @@ async def save_flow(bot_id: str, flow: Flow) -> Bot:
     updated = bot.model_copy(update={"flow": flow})
     update_bot_row(updated)
     FLOW_CACHE[bot_id] = flow
+    refresh_bot_schedules(bot_id)
+    schedule_media_prewarm(updated, flow)
     return updated
 
 
@@ -2820,6 +5088,7 @@ async def start_bot(bot_id: str) -> Bot:
     if not bot.token:
         raise HTTPException(status_code=400, detail="Bot token is required")
     FLOW_CACHE[bot_id] = bot.flow
+    schedule_media_prewarm(bot, bot.flow)
     if bot_id in RUNNING_BOTS:
         updated = bot.model_copy(update={"status": "running"})
         update_bot_row(updated)